@@ -22,14 +22,37 @@ subprocess and a network socket.
 All timeouts are in milliseconds.
 """
 
+import binascii
+import codecs
+import collections
+import contextlib
+import functools
+import hashlib
 import io
+import json
 import os
 import socket
 import posixpath
+import re
+import tarfile
+import threading
+import time
+import zipfile
+
+try:
+    from shlex import quote as _ShellQuote
+except ImportError:  # Python 2
+    from pipes import quote as _ShellQuote
 
 from adb import adb_protocol
 from adb import common
+from adb import device_file
 from adb import filesync_protocol
+from adb import forward
+from adb import logcat
+from adb import sideload
+from adb import stream_match
+from adb import usb_exceptions
 
 # From adb.h
 CLASS = 0xFF
@@ -38,6 +61,18 @@ PROTOCOL = 0x01
 # pylint: disable=invalid-name
 DeviceIsAvailable = common.InterfaceMatcher(CLASS, SUBCLASS, PROTOCOL)
 
+# Directories with at least this many files, averaging at most
+# BULK_PUSH_MAX_AVERAGE_SIZE bytes each, are pushed as one tar stream.
+BULK_PUSH_MIN_FILES = 32
+BULK_PUSH_MAX_AVERAGE_SIZE = 64 * 1024
+
+# Tar compressions by archive filename suffix, for PullArchive.
+_TAR_COMPRESSIONS = (
+    (('.tar.gz', '.tgz'), 'gz'),
+    (('.tar.bz2', '.tbz2'), 'bz2'),
+    (('.tar.xz', '.txz'), 'xz'),
+)
+
 try:
     # Imported locally to keep compatibility with previous code.
     from adb.sign_cryptography import CryptographySigner
@@ -46,6 +81,503 @@ except ImportError:
     pass
 
 
+def _OpenArchive(path, write=False):
+    """Opens a zip or (possibly compressed) tar file in streaming mode."""
+    if write:
+        if path.endswith('.zip'):
+            return zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for suffixes, compression in _TAR_COMPRESSIONS:
+            if path.endswith(suffixes):
+                return tarfile.open(path, 'w|' + compression)
+        return tarfile.open(path, 'w|')
+    if zipfile.is_zipfile(path):
+        return zipfile.ZipFile(path)
+    return tarfile.open(path, 'r|*')
+
+
+def _ResetOwner(tarinfo):
+    """tarfile filter dropping host ownership, which the device can't apply."""
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+
+def _SafeTarMember(tarinfo):
+    """Returns tarinfo renamed to stay inside the extraction directory.
+
+    For Pythons without tarfile.data_filter. Links that could point outside
+    of it and device files are skipped by returning None.
+    """
+    name = filesync_protocol.SafeMemberPath(tarinfo.name)
+    if not name or tarinfo.isdev():
+        return None
+    if tarinfo.issym():
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), tarinfo.linkname))
+        if posixpath.isabs(tarinfo.linkname) or target == '..' or target.startswith('../'):
+            return None
+    elif tarinfo.islnk():
+        tarinfo.linkname = filesync_protocol.SafeMemberPath(tarinfo.linkname)
+        if not tarinfo.linkname:
+            return None
+    tarinfo.name = name
+    return tarinfo
+
+
+class _StreamWriter(object):
+    """File-like object sending its data in full-sized packets."""
+
+    def __init__(self, send, packet_size=adb_protocol.MAX_ADB_DATA):
+        self._send = send
+        self._packet_size = packet_size
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._packet_size:
+            self._send(bytes(self._buffer[:self._packet_size]))
+            del self._buffer[:self._packet_size]
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self._send(bytes(self._buffer))
+            del self._buffer[:]
+
+
+def _OpenWithStdin(protocol_handler, handle, command, shell_v2, timeout_ms=None):
+    """Opens command for writing to its stdin.
+
+    Uses the raw shell,v2 service when the device supports it, so stdout,
+    stderr and the exit code are kept apart and stdin can be closed on its own.
+    Otherwise falls back to exec:.
+
+    Args:
+      shell_v2: Whether the device supports shell v2, from its banner features.
+
+    Returns:
+      (connection, ShellV2Connection or None for exec:, packet writer).
+    """
+    if not isinstance(command, bytes):
+        command = command.encode('utf8')
+    if not shell_v2:
+        connection = protocol_handler.Open(
+            handle, destination=b'exec:%s' % command, timeout_ms=timeout_ms)
+        return connection, None, _StreamWriter(connection.Write)
+    connection = protocol_handler.Open(
+        handle, destination=b'shell,v2,raw:%s' % command, timeout_ms=timeout_ms)
+    shell = adb_protocol.ShellV2Connection(connection)
+    return connection, shell, _StreamWriter(shell.WriteStdin, shell.max_payload)
+
+
+class _CommandInput(object):
+    """File-like stdin of a device command, whose output is collected by Finish.
+
+    Under exec:, output written after the input ends is lost and there is no
+    exit code.
+    """
+
+    def __init__(self, protocol_handler, handle, command, shell_v2, timeout_ms=None):
+        self._connection, self._shell, self._writer = _OpenWithStdin(
+            protocol_handler, handle, command, shell_v2, timeout_ms=timeout_ms)
+
+    def write(self, data):
+        return self._writer.write(data)
+
+    def Finish(self):
+        """Ends the command's input and returns an adb_protocol.ShellResult of bytes."""
+        self._writer.flush()
+        if self._shell:
+            self._shell.CloseStdin()
+            return self._shell.ReadResult()
+        output = self._connection.PendingData()
+        self._connection.Close()
+        return adb_protocol.ShellResult(output, b'', None)
+
+
+class ShellBatch(object):
+    """Runs many short commands over one persistent shell stream.
+
+    Each command is followed by a printf of a unique marker and its exit code,
+    so commands can be pipelined and their outputs split apart as they stream
+    back, without an OPEN/CLSE handshake and a new shell per command. Commands
+    run in the same shell, so cd and variables carry over, and read stdin
+    from /dev/null. A command calling exit ends the session.
+
+    Use AdbCommands.ShellBatch to create one.
+    """
+
+    def __init__(self, protocol_handler, handle, shell_v2, timeout_ms=None):
+        self._connection, self._shell, self._writer = _OpenWithStdin(
+            protocol_handler, handle, 'sh', shell_v2, timeout_ms=timeout_ms)
+        if self._shell:
+            self._packets = self._shell.ReadPackets()
+        else:
+            self._packets = ((adb_protocol.SHELL_ID_STDOUT, data)
+                             for data in self._connection.ReadUntilClose())
+        self._token = binascii.hexlify(os.urandom(8)).decode('ascii')
+        self._count = 0
+        # Markers of the commands sent but not read back yet.
+        self._expected = collections.deque()
+        self._stdout = bytearray()
+        self._stderr = bytearray()
+
+    def _Script(self, command, marker):
+        if self._shell:
+            return "{ %s\n} </dev/null; printf '%%s%%d\\n' %s $?; printf '%%s\\n' %s >&2\n" % (
+                command, marker, marker)
+        # exec: has no separate stderr, keep it ahead of the marker.
+        return "{ %s\n} </dev/null 2>&1; printf '%%s%%d\\n' %s $?\n" % (command, marker)
+
+    def Run(self, command):
+        """Runs one command, returning an adb_protocol.ShellResult of strings."""
+        return self.RunAll([command])[0]
+
+    def RunAll(self, commands):
+        """Runs the commands, returning a list of adb_protocol.ShellResult."""
+        return list(self.IterRun(commands))
+
+    def IterRun(self, commands):
+        """Sends all the commands, then yields each result as it completes.
+
+        Under exec:, stderr is merged into stdout.
+
+        Yields:
+          adb_protocol.ShellResult of stdout and stderr strings and the exit code.
+        """
+        stale = len(self._expected)
+        for command in commands:
+            marker = 'ADB_BATCH_%s_%d:' % (self._token, self._count)
+            self._count += 1
+            self._writer.write(self._Script(command, marker).encode('utf8'))
+            self._expected.append(marker.encode('ascii'))
+        self._writer.flush()
+        # Skip the results of an earlier IterRun the caller stopped reading.
+        for _ in range(stale):
+            self._ReadResult(self._expected.popleft())
+        while self._expected:
+            yield self._ReadResult(self._expected.popleft())
+
+    def _ReadResult(self, marker):
+        scanned = 0
+        while True:
+            end = self._stdout.find(marker, scanned)
+            if end != -1:
+                newline = self._stdout.find(b'\n', end)
+                if newline != -1 and (self._shell is None or marker in self._stderr):
+                    break
+            else:
+                scanned = max(len(self._stdout) - len(marker) + 1, 0)
+            self._ReadMore()
+        stdout = bytes(self._stdout[:end])
+        exit_code = int(self._stdout[end + len(marker):newline])
+        del self._stdout[:newline + 1]
+        stderr = b''
+        if self._shell:
+            end = self._stderr.find(marker)
+            stderr = bytes(self._stderr[:end])
+            del self._stderr[:end + len(marker) + 1]
+        return adb_protocol.ShellResult(stdout.decode('utf8'), stderr.decode('utf8'), exit_code)
+
+    def _ReadMore(self):
+        try:
+            packet_id, data = next(self._packets)
+        except StopIteration:
+            raise usb_exceptions.AdbCommandFailureException(
+                'Shell session closed with %d commands pending' % (len(self._expected) + 1))
+        if packet_id == adb_protocol.SHELL_ID_STDOUT:
+            self._stdout += data
+        elif packet_id == adb_protocol.SHELL_ID_STDERR:
+            self._stderr += data
+
+    def Close(self):
+        """Ends the shell, discarding the output of commands not read back."""
+        self._writer.write(b'exit\n')
+        self._writer.flush()
+        for _ in self._packets:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+
+class ShellSessionPool(object):
+    """Pool of persistent interactive shell: sessions.
+
+    Sessions are opened lazily, up to size at a time, and checked out for
+    exclusive use, so several threads can run interactive workloads in
+    parallel without paying for a new shell each time. Sessions idle for longer
+    than idle_timeout_s are closed, and sessions failing the health check or
+    returned as broken are replaced.
+
+    Use AdbCommands.ShellPool to create one.
+    """
+
+    def __init__(self, open_session, size=4, idle_timeout_s=60.0, health_check=None):
+        """Creates the pool.
+
+        Args:
+          open_session: Callable opening a new session connection.
+          size: Maximum number of sessions open at a time.
+          idle_timeout_s: Close sessions left unused for this long.
+          health_check: Callable taking a session connection and returning
+              whether it can be reused, by default whether it is still open.
+        """
+        self._open_session = open_session
+        self.size = size
+        self.idle_timeout_s = idle_timeout_s
+        self._health_check = health_check or (lambda connection: not connection.closed)
+        self._cond = threading.Condition()
+        # (connection, time returned) of the idle sessions, most recent last.
+        self._idle = []
+        self._checked_out = 0
+        self._closed = False
+
+    def _EvictIdle(self):
+        """Removes and returns the sessions idle for too long, with the lock held."""
+        cutoff = time.time() - self.idle_timeout_s
+        expired = [connection for connection, returned in self._idle if returned < cutoff]
+        self._idle = [(connection, returned) for connection, returned in self._idle
+                      if returned >= cutoff]
+        return expired
+
+    @staticmethod
+    def _Discard(connections):
+        for connection in connections:
+            try:
+                connection.Close()
+            except Exception:
+                pass
+
+    def Checkout(self, timeout_s=None):
+        """Returns a session for exclusive use until passed to Return.
+
+        Waits up to timeout_s, forever if None, when size sessions are in use.
+
+        Raises:
+          usb_exceptions.AdbOperationException: No session became available.
+        """
+        deadline = None if timeout_s is None else time.time() + timeout_s
+        discard = []
+        try:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise usb_exceptions.AdbOperationException('Shell session pool is closed')
+                    discard.extend(self._EvictIdle())
+                    while self._idle:
+                        connection, _ = self._idle.pop()
+                        if self._health_check(connection):
+                            self._checked_out += 1
+                            return connection
+                        discard.append(connection)
+                    if self._checked_out + len(self._idle) < self.size:
+                        self._checked_out += 1
+                        break
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise usb_exceptions.AdbOperationException(
+                            'No shell session available after %s s' % timeout_s)
+                    self._cond.wait(remaining)
+        finally:
+            self._Discard(discard)
+        try:
+            return self._open_session()
+        except:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+    def Return(self, connection, broken=False):
+        """Returns a checked out session, closing it if broken."""
+        with self._cond:
+            self._checked_out -= 1
+            keep = not broken and not self._closed
+            if keep:
+                self._idle.append((connection, time.time()))
+            discard = self._EvictIdle()
+            self._cond.notify()
+        if not keep:
+            discard.append(connection)
+        self._Discard(discard)
+
+    @contextlib.contextmanager
+    def Session(self, timeout_s=None):
+        """Context manager checking out a session, returned as broken on errors."""
+        connection = self.Checkout(timeout_s)
+        try:
+            yield connection
+        except:
+            self.Return(connection, broken=True)
+            raise
+        self.Return(connection)
+
+    def Close(self):
+        """Closes the idle sessions, the others are closed when returned."""
+        with self._cond:
+            self._closed = True
+            discard = [connection for connection, _ in self._idle]
+            self._idle = []
+            self._cond.notify_all()
+        self._Discard(discard)
+
+
+class InstallCache(object):
+    """Host-side record of the apks known to be installed on each device.
+
+    Maps (serial, package) to the sha256 of the installed apk and when that
+    was last checked, so InstallIfChanged can skip even the device query while
+    the check is recent. Optionally persisted to a JSON file.
+    """
+
+    def __init__(self, path=None, max_age_s=3600.0):
+        """Creates the cache.
+
+        Args:
+          path: JSON file to load the cache from and save it to, None to keep
+              it in memory.
+          max_age_s: How long a check stays valid.
+        """
+        self.path = path
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    @staticmethod
+    def _Key(serial, package):
+        return '%s/%s' % (serial, package)
+
+    def Get(self, serial, package):
+        """Returns the sha256 recorded for package, None if unknown or too old."""
+        with self._lock:
+            entry = self._entries.get(self._Key(serial, package))
+        if entry and time.time() - entry[1] <= self.max_age_s:
+            return entry[0]
+        return None
+
+    def Put(self, serial, package, sha256):
+        with self._lock:
+            self._entries[self._Key(serial, package)] = (sha256, time.time())
+            self._Save()
+
+    def Invalidate(self, serial, package=None):
+        """Forgets package, or every package of the device if None."""
+        with self._lock:
+            if package is None:
+                prefix = self._Key(serial, '')
+                for key in [key for key in self._entries if key.startswith(prefix)]:
+                    del self._entries[key]
+            else:
+                self._entries.pop(self._Key(serial, package), None)
+            self._Save()
+
+    def _Save(self):
+        if self.path:
+            with open(self.path, 'w') as f:
+                json.dump(self._entries, f)
+
+
+class PackageInfo(object):
+    """An installed package, as listed by pm list packages."""
+
+    __slots__ = ('name', 'path', 'version_code')
+
+    def __init__(self, name, path, version_code=None):
+        self.name = name
+        self.path = path
+        self.version_code = version_code
+
+    def __repr__(self):
+        return 'PackageInfo(%r, %r, %r)' % (self.name, self.path, self.version_code)
+
+
+class PackageIndex(object):
+    """The packages installed on a device, from one pm list packages query.
+
+    Loaded on first use and kept until invalidated. Installs and uninstalls
+    made through the AdbCommands owning the index update the packages they
+    name directly, other changes, e.g. installs of unknown packages, make the
+    next lookup re-query the whole list.
+    """
+
+    def __init__(self, device):
+        self._device = device
+        self._lock = threading.Lock()
+        self._packages = None
+
+    def _Query(self, name=None):
+        """Returns a dict of name to PackageInfo of packages whose name contains name."""
+        command = 'pm list packages -f --show-versioncode'
+        if name:
+            command += ' ' + _ShellQuote(name)
+        output = self._device.Shell(command)
+        if output.strip() and not output.startswith('package:'):
+            # Before Android 9 there is no --show-versioncode.
+            output = self._device.Shell(command.replace(' --show-versioncode', ''))
+        packages = {}
+        for line in output.splitlines():
+            if not line.startswith('package:'):
+                continue
+            line, _, version_code = line[len('package:'):].rstrip().partition(' versionCode:')
+            # Paths may contain '=', package names can't.
+            path, _, package = line.rpartition('=')
+            packages[package] = PackageInfo(package, path, int(version_code) if version_code else None)
+        return packages
+
+    def _Load(self):
+        with self._lock:
+            if self._packages is None:
+                self._packages = self._Query()
+            return self._packages
+
+    def Get(self, name):
+        """Returns the PackageInfo of name, None if it isn't installed."""
+        return self._Load().get(name)
+
+    def __contains__(self, name):
+        return name in self._Load()
+
+    def __iter__(self):
+        return iter(list(self._Load().values()))
+
+    def __len__(self):
+        return len(self._Load())
+
+    def Refresh(self, name):
+        """Re-queries only name, if the index is loaded."""
+        with self._lock:
+            if self._packages is None:
+                return
+            info = self._Query(name).get(name)
+            if info is None:
+                self._packages.pop(name, None)
+            else:
+                self._packages[name] = info
+
+    def Remove(self, name):
+        with self._lock:
+            if self._packages is not None:
+                self._packages.pop(name, None)
+
+    def Invalidate(self):
+        """Makes the next lookup re-query all packages."""
+        with self._lock:
+            self._packages = None
+
+
+def _CheckExitCode(command, exit_code, stderr):
+    if exit_code:
+        raise usb_exceptions.AdbCommandFailureException(
+            '%s failed with exit code %d: %s' % (
+                command, exit_code, bytes(stderr).decode('utf8', 'replace').strip()))
+
+
 class AdbCommands(object):
     """Exposes adb-like methods for use.
 
@@ -53,13 +585,25 @@ class AdbCommands(object):
     """
     protocol_handler = adb_protocol.AdbMessage
     filesync_handler = filesync_protocol.FilesyncProtocol
+    # Shared by all instances, entries are per device serial.
+    install_cache = InstallCache()
 
     def __init__(self):
 
         self.__reset()
 
     def __reset(self):
+        # Properties from the device's banner, e.g. ro.product.model.
         self.build_props = None
+        # Features advertised by the device in its banner, e.g. shell_v2 and cmd.
+        self.features = set()
+        # All properties from getprop, loaded by GetProp.
+        self._props = None
+        self.last_install_mode = None
+        # Installed packages, created by the packages property.
+        self._packages = None
+        # ForwardServers started by Forward, closed with the connection.
+        self._forwards = []
         self._handle = None
         self._device_state = None
 
@@ -144,6 +688,9 @@ class AdbCommands(object):
         return self
 
     def Close(self):
+        for server in list(self._forwards):
+            server.Close()
+
         for conn in list(self._service_connections.values()):
             if conn:
                 try:
@@ -176,8 +723,14 @@ class AdbCommands(object):
         parts = conn_str.split(b'::')
         self._device_state = parts[0]
 
-        # Break out the build prop info
-        self.build_props = str(parts[1].split(b';'))
+        # Break out the build prop info, e.g. ro.product.name=x;ro.product.model=y;features=cmd
+        self.build_props = {}
+        for prop in parts[1].rstrip(b'\0').decode('utf8', 'replace').split(';'):
+            key, sep, value = prop.partition('=')
+            if sep:
+                self.build_props[key] = value
+        self.features = set(filter(None, self.build_props.pop('features', '').split(',')))
+        self._props = None
 
         return True
 
@@ -189,8 +742,28 @@ class AdbCommands(object):
     def GetState(self):
         return self._device_state
 
+    @property
+    def packages(self):
+        """PackageIndex of the packages installed on the device."""
+        if self._packages is None:
+            self._packages = PackageIndex(self)
+        return self._packages
+
+    def _PackageChanged(self, package_name=None):
+        """Updates the package index after installing or uninstalling package_name.
+
+        With no package_name, the whole index is re-queried on next use.
+        """
+        if self._packages is None:
+            return
+        if package_name is None:
+            self._packages.Invalidate()
+        else:
+            self._packages.Refresh(package_name)
+
     def Install(self, apk_path, destination_dir='', replace_existing=True,
-                grant_permissions=False, timeout_ms=None, transfer_progress_callback=None):
+                grant_permissions=False, timeout_ms=None, transfer_progress_callback=None, streamed=None,
+                package_name=None):
         """Install an apk to the device.
 
         Doesn't support verifier file, instead allows destination directory to be
@@ -204,21 +777,33 @@ class AdbCommands(object):
           grant_permissions: If True, grant all permissions to the app specified in its manifest
           timeout_ms: Expected timeout for pushing and installing.
           transfer_progress_callback: callback method that accepts filename, bytes_written and total_bytes of APK transfer
+          streamed: Stream the apk straight into 'cmd package install' instead
+            of pushing it, installing it and deleting it. By default used when
+            the device has the cmd feature and destination_dir isn't given.
+            The mode used is stored in last_install_mode, 'streamed' or 'push'.
+          package_name: Package name of the apk, if known, so only its entry of
+            the package index is updated instead of the whole index.
 
         Returns:
           The pm install output.
         """
+        if streamed is None:
+            streamed = not destination_dir and 'cmd' in self.features
+        if streamed:
+            self.last_install_mode = 'streamed'
+            ret = self._StreamInstall(apk_path, self._InstallOptions(replace_existing, grant_permissions),
+                                      timeout_ms=timeout_ms, progress_callback=transfer_progress_callback)
+            self._PackageChanged(package_name)
+            return ret
+        self.last_install_mode = 'push'
+
         if not destination_dir:
             destination_dir = '/data/local/tmp/'
         basename = os.path.basename(apk_path)
         destination_path = posixpath.join(destination_dir, basename)
         self.Push(apk_path, destination_path, timeout_ms=timeout_ms, progress_callback=transfer_progress_callback)
 
-        cmd = ['pm install']
-        if grant_permissions:
-            cmd.append('-g')
-        if replace_existing:
-            cmd.append('-r')
+        cmd = ['pm install'] + self._InstallOptions(replace_existing, grant_permissions)
         cmd.append('"{}"'.format(destination_path))
 
         ret = self.Shell(' '.join(cmd), timeout_ms=timeout_ms)
@@ -227,8 +812,199 @@ class AdbCommands(object):
         rm_cmd = ['rm', destination_path]
         rmret = self.Shell(' '.join(rm_cmd), timeout_ms=timeout_ms)
 
+        self._PackageChanged(package_name)
         return ret
 
+    @staticmethod
+    def _InstallOptions(replace_existing=True, grant_permissions=False):
+        options = []
+        if grant_permissions:
+            options.append('-g')
+        if replace_existing:
+            options.append('-r')
+        return options
+
+    def _StreamInstall(self, apk_path, options, timeout_ms=None, progress_callback=None):
+        """Install an apk by streaming it into the stdin of cmd package install."""
+        cmd = ['cmd package install', '-S', str(os.path.getsize(apk_path))] + options
+        return self._StreamFile(apk_path, ' '.join(cmd), timeout_ms=timeout_ms, progress_callback=progress_callback)
+
+    def _StreamFile(self, path, command, timeout_ms=None, progress_callback=None):
+        """Streams a host file into the stdin of an exec: command, returning its output.
+
+        The command must stop reading after the size of the file, e.g. with -S.
+        """
+        size = os.path.getsize(path)
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'exec:%s' % command.encode('utf8'), timeout_ms=timeout_ms)
+        written = 0
+        with open(path, 'rb') as source:
+            for chunk in iter(functools.partial(source.read, adb_protocol.MAX_ADB_DATA), b''):
+                connection.Write(chunk)
+                written += len(chunk)
+                if progress_callback:
+                    progress_callback(path, written, size)
+        # The command stops reading after size bytes, the output follows.
+        output = connection.PendingData() + b''.join(connection.ReadUntilClose())
+        return output.decode('utf8')
+
+    def InstallIfChanged(self, apk_path, package_name, **kwargs):
+        """Install an apk unless the same apk is already installed.
+
+        The installed apk is compared by sha256, which also covers its
+        versionCode and signature, with a single pm path and sha256sum query.
+        Matches are recorded in install_cache, so while a check is recent not
+        even the query is made.
+
+        Args:
+          apk_path: Local path to apk to install.
+          package_name: Package name of the apk.
+          **kwargs: See Install.
+
+        Returns:
+          The pm install output, or None if the install was skipped, in which
+          case last_install_mode is 'skipped'.
+        """
+        sha256 = hashlib.sha256()
+        with open(apk_path, 'rb') as apk:
+            for chunk in iter(functools.partial(apk.read, 1024 * 1024), b''):
+                sha256.update(chunk)
+        sha256 = sha256.hexdigest()
+        serial = self._handle.serial_number
+
+        installed = self.install_cache.Get(serial, package_name) == sha256
+        if not installed:
+            output = self.Shell(
+                "for f in $(pm path %s | sed -n 's/^package://p'); do sha256sum \"$f\"; done" %
+                _ShellQuote(package_name), timeout_ms=kwargs.get('timeout_ms'))
+            installed = sha256 in [line.split(' ', 1)[0] for line in output.splitlines()]
+        if installed:
+            self.install_cache.Put(serial, package_name, sha256)
+            self.last_install_mode = 'skipped'
+            return None
+
+        self.install_cache.Invalidate(serial, package_name)
+        output = self.Install(apk_path, package_name=package_name, **kwargs)
+        if 'Success' in output:
+            self.install_cache.Put(serial, package_name, sha256)
+        return output
+
+    def InstallMultiple(self, apk_paths, replace_existing=True, grant_permissions=False, timeout_ms=None,
+                        transfer_progress_callback=None, parallel=4):
+        """Install the base and split apks of one app in a single session.
+
+        The apks are streamed into pm install-write, up to parallel at a time
+        over concurrent streams, and committed atomically: either all of them
+        are installed or none is.
+
+        Args:
+          apk_paths: Local paths of the base apk and its splits.
+          replace_existing: whether to replace existing application
+          grant_permissions: If True, grant all permissions to the app specified in its manifest
+          timeout_ms: Expected timeout for each step of the install.
+          transfer_progress_callback: callback method that accepts filename, bytes_written and total_bytes of each apk
+          parallel: Maximum number of apks streamed at a time.
+
+        Returns:
+          The pm install-commit output.
+
+        Raises:
+          usb_exceptions.AdbCommandFailureException: A step failed, the session
+            was abandoned.
+        """
+        return self.InstallMultiPackage([apk_paths], replace_existing=replace_existing,
+                                        grant_permissions=grant_permissions, timeout_ms=timeout_ms,
+                                        transfer_progress_callback=transfer_progress_callback,
+                                        parallel=parallel)
+
+    def InstallMultiPackage(self, packages, replace_existing=True, grant_permissions=False, timeout_ms=None,
+                            transfer_progress_callback=None, parallel=4):
+        """Install several apps, each with its splits, committed atomically.
+
+        With more than one app, a parent --multi-package session holds one
+        session per app. See InstallMultiple for the arguments.
+
+        Args:
+          packages: List of the apk paths of each app, base apk first.
+        """
+        pm = 'cmd package' if 'cmd' in self.features else 'pm'
+        options = ' '.join(self._InstallOptions(replace_existing, grant_permissions))
+        created = []
+
+        def Create(paths, extra=''):
+            command = [pm, 'install-create', extra, options]
+            if paths:
+                command.append('-S %d' % sum(os.path.getsize(path) for path in paths))
+            output = self.Shell(' '.join(part for part in command if part), timeout_ms=timeout_ms)
+            match = re.search(r'\[(\d+)\]', output)
+            if not match:
+                raise usb_exceptions.AdbCommandFailureException('install-create failed: %s' % output.strip())
+            created.append(match.group(1))
+            return match.group(1)
+
+        def Write(session, index, path):
+            output = self._StreamFile(
+                path, '%s install-write -S %d %s %d_%s -' % (
+                    pm, os.path.getsize(path), session, index, _ShellQuote(os.path.basename(path))),
+                timeout_ms=timeout_ms, progress_callback=transfer_progress_callback)
+            if 'Success' not in output:
+                raise usb_exceptions.AdbCommandFailureException(
+                    'install-write of %s failed: %s' % (path, output.strip()))
+
+        try:
+            writes = []
+            for paths in packages:
+                session = Create(paths)
+                writes.extend((session, index, path) for index, path in enumerate(paths))
+            self._RunParallel(Write, writes, parallel)
+            if len(packages) > 1:
+                parent = Create([], '--multi-package')
+                self.Shell('%s install-add-session %s %s' % (pm, parent, ' '.join(created[:-1])),
+                           timeout_ms=timeout_ms)
+            output = self.Shell('%s install-commit %s' % (pm, created[-1]), timeout_ms=timeout_ms)
+            if 'Success' not in output:
+                raise usb_exceptions.AdbCommandFailureException('install-commit failed: %s' % output.strip())
+        except:
+            for session in created:
+                try:
+                    self.Shell('%s install-abandon %s' % (pm, session), timeout_ms=timeout_ms)
+                except Exception:
+                    pass
+            raise
+        self._PackageChanged()
+        return output
+
+    @staticmethod
+    def _RunParallel(function, calls, parallel):
+        """Runs function(*args) for each args of calls on up to parallel threads.
+
+        The first exception raised by a call is re-raised once all are done.
+        """
+        calls = collections.deque(calls)
+        errors = []
+        lock = threading.Lock()
+
+        def Worker():
+            while True:
+                with lock:
+                    if not calls or errors:
+                        return
+                    args = calls.popleft()
+                try:
+                    function(*args)
+                except Exception as e:  # pylint: disable=broad-except
+                    with lock:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=Worker) for _ in range(max(min(parallel, len(calls)), 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
     def Uninstall(self, package_name, keep_data=False, timeout_ms=None):
         """Removes a package from the device.
 
@@ -240,14 +1016,19 @@ class AdbCommands(object):
         Returns:
           The pm uninstall output.
         """
+        self.install_cache.Invalidate(self._handle.serial_number, package_name)
         cmd = ['pm uninstall']
         if keep_data:
             cmd.append('-k')
         cmd.append('"%s"' % package_name)
 
-        return self.Shell(' '.join(cmd), timeout_ms=timeout_ms)
+        output = self.Shell(' '.join(cmd), timeout_ms=timeout_ms)
+        if 'Success' in output and self._packages is not None:
+            self._packages.Remove(package_name)
+        return output
 
-    def Push(self, source_file, device_filename, mtime='0', timeout_ms=None, progress_callback=None, st_mode=None):
+    def Push(self, source_file, device_filename, mtime='0', timeout_ms=None, progress_callback=None, st_mode=None,
+             overlap_io=None, bulk=None):
         """Push a file or directory to the device.
 
         Args:
@@ -259,14 +1040,31 @@ class AdbCommands(object):
           st_mode: stat mode for filename
           progress_callback: callback method that accepts filename, bytes_written and total_bytes,
                              total_bytes will be -1 for file-like objects
+          overlap_io: Read the source on a helper thread while the device is busy,
+                      or for regular files, page in their memory map there.
+                      Defaults to True when source_file is a filename.
+          bulk: For directories, whether to send them as one tar stream with
+                PushTar instead of one sync transfer per file. By default this is
+                chosen from the number and size of files, and never used when
+                progress_callback, mtime or st_mode is given, which PushTar
+                doesn't support, or without shell v2, where a failing or missing
+                tar can't be detected.
         """
 
+        if overlap_io is None:
+            overlap_io = isinstance(source_file, str)
         if isinstance(source_file, str):
             if os.path.isdir(source_file):
+                if bulk is None:
+                    bulk = (progress_callback is None and int(mtime) == 0 and st_mode is None and
+                            'shell_v2' in self.features and self._IsBulkTree(source_file))
+                if bulk:
+                    self.PushTar(source_file, device_filename, timeout_ms=timeout_ms)
+                    return
                 self.Shell("mkdir " + device_filename)
                 for f in os.listdir(source_file):
                     self.Push(os.path.join(source_file, f), device_filename + '/' + f,
-                              progress_callback=progress_callback)
+                              progress_callback=progress_callback, bulk=False)
                 return
             source_file = open(source_file, "rb")
 
@@ -277,35 +1075,51 @@ class AdbCommands(object):
             if st_mode is not None:
                 kwargs['st_mode'] = st_mode
             self.filesync_handler.Push(connection, source_file, device_filename,
-                                       mtime=int(mtime), progress_callback=progress_callback, **kwargs)
+                                       mtime=int(mtime), progress_callback=progress_callback,
+                                       overlap_io=overlap_io, **kwargs)
         connection.Close()
 
-    def Pull(self, device_filename, dest_file=None, timeout_ms=None, progress_callback=None):
+    @staticmethod
+    def _IsBulkTree(source_dir):
+        """Whether source_dir has enough small files to be pushed with PushTar."""
+        # lstat, so broken symlinks are counted rather than raising.
+        sizes = [os.lstat(os.path.join(root, f)).st_size
+                 for root, _, files in os.walk(source_dir) for f in files]
+        return (len(sizes) >= BULK_PUSH_MIN_FILES and
+                sum(sizes) <= BULK_PUSH_MAX_AVERAGE_SIZE * len(sizes))
+
+    def Pull(self, device_filename, dest_file=None, timeout_ms=None, progress_callback=None, overlap_io=None):
         """Pull a file from the device.
 
         Args:
           device_filename: Filename on the device to pull.
-          dest_file: If set, a filename or writable file-like object.
+          dest_file: If set, a filename or writable file-like object. Filenames are
+                     preallocated and written through a memory map.
           timeout_ms: Expected timeout for any part of the pull.
           progress_callback: callback method that accepts filename, bytes_written and total_bytes,
                              total_bytes will be -1 for file-like objects
+          overlap_io: Write dest_file on a helper thread while the device is busy.
+                      Defaults to True when dest_file is a filename.
 
         Returns:
           The file data if dest_file is not set. Otherwise, True if the destination file exists
         """
+        use_mmap = isinstance(dest_file, str)
+        if overlap_io is None:
+            overlap_io = use_mmap
         if not dest_file:
             dest_file = io.BytesIO()
-        elif isinstance(dest_file, str):
-            dest_file = open(dest_file, 'wb')
-        elif isinstance(dest_file, file):
-            pass
-        else:
+        elif use_mmap:
+            # Opened for reading too, which mmap requires.
+            dest_file = open(dest_file, 'w+b')
+        elif not hasattr(dest_file, 'write'):
             raise ValueError("destfile is of unknown type")
 
         conn = self.protocol_handler.Open(
             self._handle, destination=b'sync:', timeout_ms=timeout_ms)
 
-        self.filesync_handler.Pull(conn, device_filename, dest_file, progress_callback)
+        self.filesync_handler.Pull(conn, device_filename, dest_file, progress_callback,
+                                   overlap_io=overlap_io, use_mmap=use_mmap)
 
         conn.Close()
         if isinstance(dest_file, io.BytesIO):
@@ -317,6 +1131,181 @@ class AdbCommands(object):
             # We don't know what the path is, so we just assume it exists.
             return True
 
+    def PushIter(self, chunks, device_filename, mtime='0', timeout_ms=None, progress_callback=None, st_mode=None):
+        """Push data produced by an iterable to a file on the device.
+
+        Args:
+          chunks: Iterable of bytes-like objects making up the file contents.
+          device_filename: Destination on the device to write to.
+          mtime: Optional, modification time to set on the file.
+          timeout_ms: Expected timeout for any part of the push.
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes,
+                             total_bytes will be -1
+          st_mode: stat mode for filename
+        """
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'sync:', timeout_ms=timeout_ms)
+        kwargs = {}
+        if st_mode is not None:
+            kwargs['st_mode'] = st_mode
+        self.filesync_handler.PushIter(connection, chunks, device_filename,
+                                       mtime=int(mtime), progress_callback=progress_callback, **kwargs)
+        connection.Close()
+
+    def PullIter(self, device_filename, timeout_ms=None):
+        """Pull a file from the device, yielding its contents as they arrive.
+
+        Args:
+          device_filename: Filename on the device to pull.
+          timeout_ms: Expected timeout for any part of the pull.
+
+        Yields:
+          memoryviews over consecutive pieces of the file.
+        """
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'sync:', timeout_ms=timeout_ms)
+        try:
+            for data in self.filesync_handler.PullIter(connection, device_filename):
+                yield data
+        finally:
+            connection.Close()
+
+    def PushArchive(self, archive, device_dir, timeout_ms=None, progress_callback=None):
+        """Push the members of a tar or zip archive without extracting it on the host.
+
+        All members are sent over one sync connection, keeping their modes and
+        modification times.
+
+        Args:
+          archive: Path to a tar (optionally compressed) or zip file, or an open
+                   tarfile.TarFile or zipfile.ZipFile.
+          device_dir: Directory on the device to push the members into.
+          timeout_ms: Expected timeout for any part of the push.
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes,
+                             total_bytes will be -1
+
+        Returns:
+          The list of device paths that were written.
+        """
+        if isinstance(archive, str):
+            with _OpenArchive(archive) as opened:
+                return self.PushArchive(opened, device_dir, timeout_ms, progress_callback)
+
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'sync:', timeout_ms=timeout_ms)
+        pushed = self.filesync_handler.PushArchive(
+            connection, archive, device_dir, progress_callback=progress_callback)
+        connection.Close()
+        return pushed
+
+    def PullArchive(self, device_path, archive, timeout_ms=None, progress_callback=None):
+        """Pull a device directory tree straight into a tar or zip archive.
+
+        The tree is listed and pulled over one sync connection and streamed into
+        the archive without temporary files.
+
+        Args:
+          device_path: Directory on the device to pull.
+          archive: Path of the archive to create, its format is chosen from the
+                   extension (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz), or a
+                   tarfile.TarFile or zipfile.ZipFile open for writing.
+          timeout_ms: Expected timeout for any part of the pull.
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes
+
+        Returns:
+          The list of archive member names that were written.
+        """
+        if isinstance(archive, str):
+            with _OpenArchive(archive, write=True) as opened:
+                return self.PullArchive(device_path, opened, timeout_ms, progress_callback)
+
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'sync:', timeout_ms=timeout_ms)
+        written = self.filesync_handler.PullArchive(
+            connection, device_path, archive, progress_callback=progress_callback)
+        connection.Close()
+        return written
+
+    def PushTar(self, source_dir, device_dir, timeout_ms=None):
+        """Push a directory tree as a single tar stream extracted on the device.
+
+        The tree is tarred incrementally into the stdin of tar -x on the device,
+        which avoids the per-file round trips of sync transfers. Requires tar on
+        the device.
+
+        Args:
+          source_dir: Directory on the host to push.
+          device_dir: Directory on the device to extract into, created if missing.
+          timeout_ms: Expected timeout for any part of the push.
+
+        Returns:
+          Any output written by tar, normally empty.
+
+        Raises:
+          usb_exceptions.AdbCommandFailureException: tar is missing or failed.
+            Only detected on devices supporting shell v2.
+        """
+        device_dir = _ShellQuote(device_dir)
+        command = 'mkdir -p %s && tar -x -C %s' % (device_dir, device_dir)
+        stdin = _CommandInput(self.protocol_handler, self._handle, command, 'shell_v2' in self.features,
+                              timeout_ms=timeout_ms)
+        with tarfile.open(fileobj=stdin, mode='w|') as archive:
+            for name in sorted(os.listdir(source_dir)):
+                archive.add(os.path.join(source_dir, name), arcname=name, filter=_ResetOwner)
+        result = stdin.Finish()
+        _CheckExitCode(command, result.exit_code, result.stderr)
+        return (result.stdout + result.stderr).decode('utf8', 'replace')
+
+    def PullTar(self, device_dir, dest_dir, timeout_ms=None):
+        """Pull a device directory tree as a single tar stream from tar -c.
+
+        The stream is untarred incrementally as it arrives. Requires tar on the
+        device.
+
+        Args:
+          device_dir: Directory on the device to pull.
+          dest_dir: Directory on the host to extract into.
+          timeout_ms: Expected timeout for any part of the pull.
+
+        Returns:
+          The names of the extracted members.
+
+        Raises:
+          usb_exceptions.AdbCommandFailureException: tar is missing or failed.
+            Only detected on devices supporting shell v2.
+        """
+        command = 'tar -c -C %s .' % _ShellQuote(device_dir)
+        shell = self._OpenShellV2(command, timeout_ms)
+        if shell is None:
+            # exec: merges stderr into the tar stream.
+            chunks = self.StreamingExec(command + ' 2>/dev/null', timeout_ms=timeout_ms)
+        else:
+            chunks = shell.ReadStdout()
+        reader = filesync_protocol.ChunkReader(chunks)
+        names = []
+        try:
+            with tarfile.open(fileobj=reader, mode='r|') as archive:
+                for member in archive:
+                    if hasattr(tarfile, 'data_filter'):
+                        archive.extract(member, dest_dir, filter='data')
+                    else:
+                        member = _SafeTarMember(member)
+                        if member is None:
+                            continue
+                        archive.extract(member, dest_dir)
+                    names.append(member.name)
+        except tarfile.ReadError:
+            # Most likely tar failed before writing anything, report why.
+            reader.Drain()
+            if shell:
+                _CheckExitCode(command, shell.exit_code, shell.stderr)
+            raise
+        # Read up to the device's close, past tar's end-of-archive padding.
+        reader.Drain()
+        if shell:
+            _CheckExitCode(command, shell.exit_code, shell.stderr)
+        return names
+
     def Stat(self, device_filename):
         """Get a file's stat() information."""
         connection = self.protocol_handler.Open(self._handle, destination=b'sync:')
@@ -325,6 +1314,25 @@ class AdbCommands(object):
         connection.Close()
         return mode, size, mtime
 
+    def OpenDeviceFile(self, device_filename, block_size=device_file.DEFAULT_BLOCK_SIZE, cache_blocks=32,
+                       timeout_ms=None):
+        """Open a device file for reading without pulling all of it.
+
+        Args:
+          device_filename: Path of the file on the device.
+          block_size: Size of the blocks fetched from the device.
+          cache_blocks: Number of blocks kept in memory.
+          timeout_ms: Timeout for USB packets, in milliseconds.
+
+        Returns:
+          A seekable, read-only device_file.DeviceFileReader.
+        """
+        mode, size, _ = self.Stat(device_filename)
+        if not mode:
+            raise usb_exceptions.AdbCommandFailureException('No such file: %s' % device_filename)
+        return device_file.DeviceFileReader(self, device_filename, size, block_size=block_size,
+                                            cache_blocks=cache_blocks, timeout_ms=timeout_ms)
+
     def List(self, device_path):
         """Return a directory listing of the given path.
 
@@ -336,24 +1344,103 @@ class AdbCommands(object):
         connection.Close()
         return listing
 
+    def GetProp(self, name, default=None, refresh=False):
+        """Get a device property without a round trip per lookup.
+
+        Properties from the banner are answered directly, any other property
+        loads all properties with a single getprop, kept until refresh,
+        InvalidateProps or a reboot or root through this object.
+
+        Args:
+          name: Property name, e.g. 'ro.build.version.sdk'.
+          default: Returned if the property isn't set.
+          refresh: Reload the properties from the device first.
+
+        Returns:
+          The property value as a string.
+        """
+        if refresh:
+            self._props = None
+        elif self._props is None and self.build_props and name in self.build_props:
+            return self.build_props[name]
+        if self._props is None:
+            self._props = self.GetProps()
+        return self._props.get(name, default)
+
+    def GetProps(self):
+        """Get all device properties from one getprop, as a dict."""
+        output = self.Shell('getprop').replace('\r\n', '\n')
+        return dict(re.findall(r'^\[([^\]]+)\]: \[(.*?)\]$', output, re.M | re.S))
+
+    def InvalidateProps(self):
+        """Forget the properties loaded by GetProp."""
+        self._props = None
+
     def Reboot(self, destination=b''):
         """Reboot the device.
 
         Args:
           destination: Specify 'bootloader' for fastboot.
         """
+        self.InvalidateProps()
         self.protocol_handler.Open(self._handle, b'reboot:%s' % destination)
 
     def RebootBootloader(self):
         """Reboot device into fastboot."""
         self.Reboot(b'bootloader')
 
+    def Forward(self, local_port, remote=None, host='127.0.0.1', timeout_ms=None):
+        """Forward connections to a local TCP port to a device service.
+
+        Args:
+          local_port: Local port to listen on, 0 for any free port.
+          remote: Device service to connect to, e.g. 'tcp:8080' or
+            'localabstract:name'. Defaults to the same TCP port on the device,
+            which requires a local_port other than 0.
+          host: Local address to listen on.
+          timeout_ms: Timeout for USB packets, in milliseconds.
+
+        Returns:
+          The forward.ForwardServer, whose port attribute is the local port.
+
+        Raises:
+          ValueError: remote is None and local_port is 0.
+          Call its Close method to stop forwarding, which also happens when
+          this connection is closed.
+        """
+        if remote is None:
+            if not local_port:
+                raise ValueError('remote is required when forwarding from any free port')
+            remote = 'tcp:%d' % local_port
+        if not isinstance(remote, bytes):
+            remote = remote.encode('utf8')
+        server = forward.ForwardServer(self._handle, remote, local_port=local_port, host=host,
+                                       timeout_ms=timeout_ms, close_callback=self._forwards.remove)
+        self._forwards.append(server)
+        return server
+
+    def Sideload(self, path, block_size=sideload.DEFAULT_BLOCK_SIZE, progress_callback=None, timeout_ms=None):
+        """Install an OTA package on a device in recovery's sideload mode.
+
+        Args:
+          path: Local path of the OTA package.
+          block_size: Size of the blocks the device requests.
+          progress_callback: callback method that accepts path, blocks_served and total_blocks
+          timeout_ms: Timeout for USB packets, in milliseconds.
+
+        Raises:
+          sideload.SideloadFailedError: The device failed to install the package.
+        """
+        sideload.Sideload(self._handle, path, block_size=block_size,
+                          progress_callback=progress_callback, timeout_ms=timeout_ms)
+
     def Remount(self):
         """Remount / as read-write."""
         return self.protocol_handler.Command(self._handle, service=b'remount')
 
     def Root(self):
         """Restart adbd as root on the device."""
+        self.InvalidateProps()
         return self.protocol_handler.Command(self._handle, service=b'root')
 
     def EnableVerity(self):
@@ -364,31 +1451,226 @@ class AdbCommands(object):
         """Disable dm-verity checking on userdebug builds"""
         return self.protocol_handler.Command(self._handle, service=b'disable-verity')
 
-    def Shell(self, command, timeout_ms=None):
+    def Shell(self, command, timeout_ms=None, shell_v2=False):
         """Run command on the device, returning the output.
 
         Args:
           command: Shell command to run
           timeout_ms: Maximum time to allow the command to run.
+          shell_v2: Run the command through the raw shell v2 service, which
+              keeps stderr apart and reports the exit code. Devices without
+              shell v2 fall back to shell:, with exit_code None.
+
+        Returns:
+          The output as a string, or with shell_v2 an adb_protocol.ShellResult
+          of stdout and stderr strings and the exit code.
         """
+        if shell_v2:
+            shell = self._OpenShellV2(command, timeout_ms)
+            if shell:
+                stdout, stderr, exit_code = shell.ReadResult()
+                return adb_protocol.ShellResult(stdout.decode('utf8'), stderr.decode('utf8'), exit_code)
+            return adb_protocol.ShellResult(self.Shell(command, timeout_ms=timeout_ms), '', None)
         return self.protocol_handler.Command(
             self._handle, service=b'shell', command=command,
             timeout_ms=timeout_ms)
 
-    def StreamingShell(self, command, timeout_ms=None):
-        """Run command on the device, yielding each line of output.
+    def ShellBatch(self, timeout_ms=None):
+        """Open a shell session running many commands, see ShellBatch.
+
+        Args:
+          timeout_ms: Maximum time to allow for each packet.
+
+        Returns:
+          A ShellBatch, to be closed by the caller.
+        """
+        return ShellBatch(self.protocol_handler, self._handle, 'shell_v2' in self.features, timeout_ms=timeout_ms)
+
+    def ShellPool(self, size=4, idle_timeout_s=60.0, health_check=None, timeout_ms=None):
+        """Create a pool of interactive shell sessions, see ShellSessionPool.
+
+        Sessions from the pool can be passed to InteractiveShell as conn.
+
+        Args:
+          size: Maximum number of sessions open at a time.
+          idle_timeout_s: Close sessions left unused for this long.
+          health_check: See ShellSessionPool.
+          timeout_ms: Timeout for the packets of each session.
+
+        Returns:
+          A ShellSessionPool, to be closed by the caller.
+        """
+        return ShellSessionPool(
+            functools.partial(self.protocol_handler.Open, self._handle,
+                              destination=b'shell:', timeout_ms=timeout_ms),
+            size=size, idle_timeout_s=idle_timeout_s, health_check=health_check)
+
+    def CaptureShell(self, command, timeout_ms=None, max_memory=adb_protocol.COMMAND_OUTPUT_MAX_MEMORY):
+        """Run command on the device, capturing the output with bounded memory.
+
+        Args:
+          command: Shell command to run
+          timeout_ms: Maximum time to allow the command to run.
+          max_memory: Bytes of output to hold in memory before spilling to a
+              temporary file.
+
+        Returns:
+          An adb_protocol.CommandOutput, to be closed by the caller.
+        """
+        return self.protocol_handler.CaptureCommand(
+            self._handle, service=b'shell', command=command,
+            timeout_ms=timeout_ms, max_memory=max_memory)
+
+    def StreamingShell(self, command, timeout_ms=None, shell_v2=False):
+        """Run command on the device, yielding the output as it arrives.
+
+        See StreamingShellLines to iterate over lines instead.
 
         Args:
           command: Command to run on the target.
           timeout_ms: Maximum time to allow the command to run.
+          shell_v2: Run the command through the raw shell v2 service, see Shell.
 
         Yields:
-          The responses from the shell command.
+          The responses from the shell command. With shell_v2, (packet_id, data)
+          tuples where packet_id is adb_protocol.SHELL_ID_STDOUT or SHELL_ID_STDERR
+          and data a string, then (SHELL_ID_EXIT, exit code) if the device
+          supports shell v2.
         """
+        if shell_v2:
+            return self._StreamingShellV2(command, timeout_ms)
         return self.protocol_handler.StreamingCommand(
             self._handle, service=b'shell', command=command,
             timeout_ms=timeout_ms)
 
+    def StreamingShellLines(self, command, timeout_ms=None, encoding='utf8', newline=None, keepends=False):
+        """Run command on the device, yielding each line of output.
+
+        Args:
+          command: Command to run on the target.
+          timeout_ms: Maximum time to allow the command to run.
+          encoding: Encoding of the output, None to yield bytes.
+          newline: The line terminator, by default '\n' with an optional '\r'
+              before it as written by the PTY.
+          keepends: Keep the line terminators.
+
+        Yields:
+          The lines of output.
+        """
+        return adb_protocol.IterLines(
+            self.protocol_handler.StreamingRawCommand(
+                self._handle, service=b'shell', command=command, timeout_ms=timeout_ms),
+            encoding=encoding, newline=newline, keepends=keepends)
+
+    def _OpenShellV2(self, command, timeout_ms=None):
+        """Opens command on the raw shell v2 service, None if unsupported.
+
+        Support is taken from the banner features rather than probed: adbd
+        answers an unknown service with a single CLSE, while Open only gives
+        up on a service after a second one.
+        """
+        if 'shell_v2' not in self.features:
+            return None
+        if not isinstance(command, bytes):
+            command = command.encode('utf8')
+        connection = self.protocol_handler.Open(
+            self._handle, destination=b'shell,v2,raw:%s' % command, timeout_ms=timeout_ms)
+        return connection and adb_protocol.ShellV2Connection(connection)
+
+    def _StreamingShellV2(self, command, timeout_ms=None):
+        shell = self._OpenShellV2(command, timeout_ms)
+        if shell is None:
+            for data in self.StreamingShell(command, timeout_ms=timeout_ms):
+                yield adb_protocol.SHELL_ID_STDOUT, data
+            return
+        decoders = {}
+        try:
+            for packet_id, data in shell.ReadPackets():
+                if packet_id != adb_protocol.SHELL_ID_EXIT:
+                    if packet_id not in decoders:
+                        decoders[packet_id] = codecs.getincrementaldecoder('utf8')()
+                    data = decoders[packet_id].decode(data)
+                    if not data:
+                        continue
+                yield packet_id, data
+        except GeneratorExit:
+            shell.adb.Close()
+            raise
+
+    def StreamingExec(self, command, timeout_ms=None):
+        """Run command through the exec: service, yielding its raw output.
+
+        Unlike Shell there is no PTY and no decoding, so binary output (screencap,
+        tar, traces) arrives intact.
+
+        Args:
+          command: Command to run on the target.
+          timeout_ms: Maximum time to allow the command to run.
+
+        Yields:
+          The output of the command as bytes, one ADB packet at a time.
+        """
+        return self.protocol_handler.StreamingRawCommand(
+            self._handle, service=b'exec', command=command,
+            timeout_ms=timeout_ms)
+
+    def ExecIn(self, command, source, timeout_ms=None):
+        """Run command on the device, streaming source into its stdin.
+
+        Uses the raw shell,v2 service so stdin can be closed once source is
+        exhausted while the output and exit code are still received. File-like
+        sources are read on a helper thread while each packet waits for its ack.
+        Devices without shell v2 fall back to exec:, where only the output
+        written while the input is being sent is received.
+
+        Args:
+          command: Command to run on the target, e.g. 'cat > /data/local/tmp/x'.
+          source: File-like object or iterable of bytes-like chunks.
+          timeout_ms: Maximum time to allow for each packet.
+
+        Returns:
+          An adb_protocol.ShellResult of stdout and stderr bytes and the exit
+          code. Under exec: stderr is merged into stdout and exit_code is None.
+        """
+        stdin = _CommandInput(self.protocol_handler, self._handle, command, 'shell_v2' in self.features,
+                              timeout_ms=timeout_ms)
+        reader = None
+        if hasattr(source, 'read'):
+            source = reader = filesync_protocol.ReaderThread(
+                iter(functools.partial(source.read, adb_protocol.ShellV2Connection.max_payload), b''))
+        try:
+            for chunk in source:
+                stdin.write(chunk)
+        finally:
+            if reader:
+                reader.Close()
+        return stdin.Finish()
+
+    def ExecOut(self, command, dest_file=None, timeout_ms=None):
+        """Run command through the exec: service, returning or saving its raw output.
+
+        Args:
+          command: Command to run on the target.
+          dest_file: If set, a filename or writable file-like object the output is
+                     streamed into instead of being held in memory.
+          timeout_ms: Maximum time to allow the command to run.
+
+        Returns:
+          The output as bytes if dest_file is not set. Otherwise, the number of
+          bytes written.
+        """
+        if isinstance(dest_file, str):
+            with open(dest_file, 'wb') as dest:
+                return self.ExecOut(command, dest, timeout_ms)
+        output = self.StreamingExec(command, timeout_ms=timeout_ms)
+        if dest_file is None:
+            return b''.join(output)
+        written = 0
+        for data in output:
+            dest_file.write(data)
+            written += len(data)
+        return written
+
     def Logcat(self, options, timeout_ms=None):
         """Run 'shell logcat' and stream the output to stdout.
 
@@ -398,7 +1680,53 @@ class AdbCommands(object):
         """
         return self.StreamingShell('logcat %s' % options, timeout_ms)
 
-    def InteractiveShell(self, cmd=None, strip_cmd=True, delim=None, strip_delim=True):
+    def BinaryLogcat(self, options='', tags=None, min_priority=None, timeout_ms=None):
+        """Run logcat -B through exec: and yield its parsed entries.
+
+        Avoids the cost of formatting and regex-parsing text lines, see
+        logcat.ParseBinaryLog.
+
+        Args:
+          options: Further arguments to pass to 'logcat', e.g. '-d'.
+          tags: Only yield entries with one of these tags.
+          min_priority: Only yield entries of at least this priority, e.g. logcat.WARN.
+          timeout_ms: Maximum time to wait for each packet of output.
+
+        Yields:
+          logcat.LogEntry tuples.
+        """
+        return logcat.ParseBinaryLog(
+            self.StreamingExec('logcat -B %s' % options, timeout_ms=timeout_ms),
+            tags=tags, min_priority=min_priority)
+
+    def CaptureLogcat(self, path, options='', **kwargs):
+        """Create a capture of logcat to rotated files, see logcat.LogcatCapture.
+
+        Args:
+          path: Prefix of the capture files.
+          options: Further arguments to pass to 'logcat'.
+          **kwargs: See logcat.LogcatCapture, e.g. max_bytes and reconnect.
+
+        Returns:
+          A logcat.LogcatCapture, started with its Run method.
+        """
+        return logcat.LogcatCapture(self, path, options=options, **kwargs)
+
+    def WaitForLogcat(self, patterns, options='', timeout_s=None, timeout_ms=None):
+        """Wait for the first of several log lines, see stream_match.WaitFor.
+
+        Args:
+          patterns: Literal strings and compiled regexes to look for.
+          options: Arguments to pass to 'logcat'.
+          timeout_s: Give up after this many seconds.
+          timeout_ms: Maximum time to wait for each packet of output.
+
+        Returns:
+          A stream_match.Match, or None if logcat ended or timeout_s expired.
+        """
+        return stream_match.WaitFor(self.Logcat(options, timeout_ms), patterns, timeout_s=timeout_s)
+
+    def InteractiveShell(self, cmd=None, strip_cmd=True, delim=None, strip_delim=True, conn=None):
         """Get stdout from the currently open interactive shell and optionally run a command
             on the device, returning all output.
 
@@ -408,12 +1736,30 @@ class AdbCommands(object):
           delim: Optional. Delimiter to look for in the output to know when to stop expecting more output
           (usually the shell prompt)
           strip_delim: Optional (default True): Strip the provided delimiter from the output
+          conn: Optional. Shell session to use, e.g. from ShellPool, instead of the shared one.
 
         Returns:
           The stdout from the shell command.
         """
-        conn = self._get_service_connection(b'shell:')
+        if conn is None:
+            conn = self._get_service_connection(b'shell:')
 
         return self.protocol_handler.InteractiveShellCommand(
             conn, cmd=cmd, strip_cmd=strip_cmd,
             delim=delim, strip_delim=strip_delim)
+
+    def StreamingInteractiveShell(self, cmd=None, strip_cmd=True, delim=None, strip_delim=True, conn=None):
+        """Like InteractiveShell, but yields the output as it arrives.
+
+        Args:
+          See InteractiveShell.
+
+        Yields:
+          The stdout from the shell command as bytes, a line at a time.
+        """
+        if conn is None:
+            conn = self._get_service_connection(b'shell:')
+
+        return self.protocol_handler.StreamingInteractiveShellCommand(
+            conn, cmd=cmd, strip_cmd=strip_cmd,
+            delim=delim, strip_delim=strip_delim)
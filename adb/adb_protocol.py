@@ -17,8 +17,13 @@ Implements the ADB protocol as seen in android's adb/adbd binaries, but only the
 host side.
 """
 
+import codecs
+import collections
 import struct
+import tempfile
+import threading
 import time
+import weakref
 from io import BytesIO
 from adb import usb_exceptions
 
@@ -32,6 +37,19 @@ AUTH_TOKEN = 1
 AUTH_SIGNATURE = 2
 AUTH_RSAPUBLICKEY = 3
 
+# Shell protocol v2 packet ids, from adb's shell_protocol.h.
+SHELL_ID_STDIN = 0
+SHELL_ID_STDOUT = 1
+SHELL_ID_STDERR = 2
+SHELL_ID_EXIT = 3
+SHELL_ID_CLOSE_STDIN = 4
+SHELL_ID_WINDOW_SIZE_CHANGE = 5
+
+ShellResult = collections.namedtuple('ShellResult', ['stdout', 'stderr', 'exit_code'])
+
+# Output kept in memory by CommandOutput before spilling to a temporary file.
+COMMAND_OUTPUT_MAX_MEMORY = 1024 * 1024
+
 
 def find_backspace_runs(stdout_bytes, start_pos):
     first_backspace_pos = stdout_bytes[start_pos:].find(b'\x08')
@@ -50,6 +68,57 @@ def find_backspace_runs(stdout_bytes, start_pos):
     return (start_pos + first_backspace_pos), num_backspaces
 
 
+def _PartialDelim(delim):
+    """Returns the part of a prompt delimiter that stays the same.
+
+    Delimiter may be shell@hammerhead:/ $
+    The user or directory could change, making the delimiter somthing like root@hammerhead:/data/local/tmp $
+    """
+    if not delim:
+        return None
+    user_pos = delim.find(b'@')
+    dir_pos = delim.rfind(b':/')
+    if user_pos != -1 and dir_pos != -1:
+        return delim[user_pos:dir_pos + 1]  # e.g. @hammerhead:
+    return delim
+
+
+class _TerminalCleaner(object):
+    """Removes backspaces and the characters they erase, in a single pass.
+
+    Output is returned a line at a time, the current line is held back since
+    later backspaces may still erase from it.
+    """
+
+    def __init__(self):
+        self._line = bytearray()
+
+    def feed(self, data):
+        """Adds data, returning the lines it completed."""
+        start = 0
+        while True:
+            pos = data.find(b'\x08', start)
+            if pos == -1:
+                break
+            self._line += data[start:pos]
+            end = pos + 1
+            while data[end:end + 1] == b'\x08':
+                end += 1
+            del self._line[max(len(self._line) - (end - pos), 0):]
+            start = end
+        self._line += data[start:]
+        newline = self._line.rfind(b'\n') + 1
+        lines = bytes(self._line[:newline])
+        del self._line[:newline]
+        return lines
+
+    def flush(self):
+        """Returns the unterminated last line."""
+        line = bytes(self._line)
+        del self._line[:]
+        return line
+
+
 class InvalidCommandError(Exception):
     """Got an invalid command over USB."""
 
@@ -93,6 +162,89 @@ class AuthSigner(object):
         raise NotImplementedError()
 
 
+class _StreamRouter(object):
+    """Shares one transport between several streams.
+
+    Each open stream gets the lowest free local id. Whichever thread needs a
+    packet reads the next one from the transport and queues it for the stream
+    it is addressed to, so streams can be used concurrently from different
+    threads instead of raising InterleavedDataError.
+    """
+
+    _routers = weakref.WeakKeyDictionary()
+    _routers_lock = threading.Lock()
+
+    @classmethod
+    def ForHandle(cls, usb):
+        with cls._routers_lock:
+            router = cls._routers.get(usb)
+            if router is None:
+                router = cls._routers[usb] = cls(usb)
+            return router
+
+    def __init__(self, usb):
+        self.usb = usb
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        # Packets read for each open local id but not consumed yet.
+        self._queues = {}
+        self._reading = False
+
+    def Allocate(self):
+        """Reserves and returns the lowest free local id."""
+        with self._cond:
+            local_id = 1
+            while local_id in self._queues:
+                local_id += 1
+            self._queues[local_id] = collections.deque()
+            return local_id
+
+    def Release(self, local_id):
+        """Frees local_id, later packets for it are dropped."""
+        with self._cond:
+            self._queues.pop(local_id, None)
+
+    def HasQueued(self, local_id, command):
+        with self._cond:
+            return any(packet[0] == command for packet in self._queues.get(local_id, ()))
+
+    def Send(self, message, timeout_ms=None):
+        with self._send_lock:
+            message.Send(self.usb, timeout_ms)
+
+    def Read(self, local_id, expected_cmds, timeout_ms=None):
+        """Receive the next packet for local_id with one of expected_cmds.
+
+        Packets for local_id with other commands are dropped, except CLSE,
+        which is always returned so no stream misses its close. Packets with
+        no local id are taken to be for the stream whose read received them.
+
+        Returns:
+          (command, arg0, arg1, data) like AdbMessage.Read.
+        """
+        with self._cond:
+            while True:
+                queue = self._queues.get(local_id, ())
+                while queue:
+                    packet = queue.popleft()
+                    if packet[0] in expected_cmds or packet[0] == b'CLSE':
+                        return packet
+                if self._reading:
+                    self._cond.wait()
+                    continue
+                self._reading = True
+                self._cond.release()
+                try:
+                    packet = AdbMessage.Read(self.usb, AdbMessage.ids, timeout_ms)
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                    self._cond.notify_all()
+                target = packet[2] or local_id
+                if target in self._queues:
+                    self._queues[target].append(packet)
+
+
 class _AdbConnection(object):
     """ADB Connection."""
 
@@ -101,16 +253,34 @@ class _AdbConnection(object):
         self.local_id = local_id
         self.remote_id = remote_id
         self.timeout_ms = timeout_ms
+        self._router = _StreamRouter.ForHandle(usb)
+        self._closed = False
+        # Whether the device closed the stream, its local id is released then.
+        self._remote_closed = False
+        # Data the device wrote to us while we were waiting for something else.
+        self._pending_data = collections.deque()
+
+    @property
+    def closed(self):
+        """Whether the stream was closed, by us or by the device."""
+        return self._closed or self._router.HasQueued(self.local_id, b'CLSE')
 
     def _Send(self, command, arg0, arg1, data=b''):
-        message = AdbMessage(command, arg0, arg1, data)
-        message.Send(self.usb, self.timeout_ms)
+        self._router.Send(AdbMessage(command, arg0, arg1, data), self.timeout_ms)
 
     def Write(self, data):
-        """Write a packet and expect an Ack."""
+        """Write a packet and expect an Ack.
+
+        Data written by the device before the Ack arrives is kept for the next
+        ReadUntil or ReadUntilClose.
+        """
         self._Send(b'WRTE', arg0=self.local_id, arg1=self.remote_id, data=data)
         # Expect an ack in response.
-        cmd, okay_data = self.ReadUntil(b'OKAY')
+        # Read past the pending data, or we'd keep popping it back.
+        cmd, okay_data = self._ReadPacket(b'OKAY', b'WRTE', b'CLSE')
+        while cmd == b'WRTE':
+            self._pending_data.append(okay_data)
+            cmd, okay_data = self._ReadPacket(b'OKAY', b'WRTE', b'CLSE')
         if cmd != b'OKAY':
             if cmd == b'FAIL':
                 raise usb_exceptions.AdbCommandFailureException(
@@ -120,15 +290,51 @@ class _AdbConnection(object):
                 cmd, okay_data)
         return len(data)
 
+    def Send(self, data):
+        """Write a packet without waiting for its Ack.
+
+        For streams read on another thread, which receives the Ack.
+        """
+        self._Send(b'WRTE', arg0=self.local_id, arg1=self.remote_id, data=data)
+
+    def SendClose(self):
+        """Ask the device to close the stream, without waiting for its CLSE."""
+        self._closed = True
+        self._Send(b'CLSE', arg0=self.local_id, arg1=self.remote_id)
+
+    def PendingData(self):
+        """Returns and forgets the data the device wrote while we were writing."""
+        data = b''.join(self._pending_data)
+        self._pending_data.clear()
+        return data
+
     def Okay(self):
         self._Send(b'OKAY', arg0=self.local_id, arg1=self.remote_id)
 
     def ReadUntil(self, *expected_cmds):
         """Read a packet, Ack any write packets."""
-        cmd, remote_id, local_id, data = AdbMessage.Read(
-            self.usb, expected_cmds, self.timeout_ms)
-        if local_id != 0 and self.local_id != local_id:
-            raise InterleavedDataError("We don't support multiple streams...")
+        if self._pending_data and b'WRTE' in expected_cmds:
+            return b'WRTE', self._pending_data.popleft()
+        return self._ReadPacket(*expected_cmds)
+
+    def _ReadPacket(self, *expected_cmds):
+        """Read a packet from the device, ignoring pending data.
+
+        Raises:
+          InvalidCommandError: The device closed the stream, and CLSE isn't
+            one of expected_cmds.
+        """
+        if self._remote_closed:
+            raise InvalidCommandError('Stream was closed by the device', b'CLSE', b'')
+        cmd, remote_id, local_id, data = self._router.Read(
+            self.local_id, expected_cmds, self.timeout_ms)
+        if cmd == b'CLSE':
+            self._closed = self._remote_closed = True
+            self._router.Release(self.local_id)
+            if cmd not in expected_cmds:
+                raise InvalidCommandError(
+                    'Stream was closed by the device, expected %s' % b'/'.join(expected_cmds).decode(),
+                    cmd, data)
         if remote_id != 0 and self.remote_id != remote_id:
             raise InvalidResponseError(
                 'Incorrect remote id, expected %s got %s' % (
@@ -154,6 +360,11 @@ class _AdbConnection(object):
             yield data
 
     def Close(self):
+        if self._remote_closed:
+            # Already closed by the device, there is no CLSE left to wait for.
+            self._closed = True
+            return
+        self._closed = True
         self._Send(b'CLSE', arg0=self.local_id, arg1=self.remote_id)
         cmd, data = self.ReadUntil(b'CLSE')
         if cmd != b'CLSE':
@@ -163,6 +374,225 @@ class _AdbConnection(object):
                                       cmd, data)
 
 
+class ShellV2Connection(object):
+    """Encapsulate a shell protocol v2 connection (shell,v2,...: services).
+
+    Every packet is a one byte id (SHELL_ID_*), a little-endian 32-bit length
+    and the payload, so stdout, stderr and the exit code arrive separately and
+    stdin can be closed without closing the stream.
+    """
+
+    header_format = b'<BI'
+    header_len = struct.calcsize(header_format)
+    # Largest payload that fits in a single ADB packet.
+    max_payload = MAX_ADB_DATA - header_len
+
+    def __init__(self, adb_connection):
+        self.adb = adb_connection
+        # Filled in by ReadStdout.
+        self.stderr = bytearray()
+        self.exit_code = None
+
+    def Send(self, packet_id, data=b''):
+        """Send one packet, data must fit in max_payload bytes."""
+        self.adb.Write(struct.pack(self.header_format, packet_id, len(data)) + bytes(data))
+
+    def WriteStdin(self, data):
+        """Send data to the command's stdin, in as many packets as needed."""
+        view = memoryview(data)
+        for offset in range(0, len(view), self.max_payload):
+            self.Send(SHELL_ID_STDIN, view[offset:offset + self.max_payload])
+
+    def CloseStdin(self):
+        self.Send(SHELL_ID_CLOSE_STDIN)
+
+    def ReadPackets(self):
+        """Yields (packet_id, data) until the device closes the stream.
+
+        The payload of SHELL_ID_EXIT packets is the exit code.
+        """
+        buf = bytearray()
+        for data in self.adb.ReadUntilClose():
+            buf += data
+            offset = 0
+            while len(buf) - offset >= self.header_len:
+                packet_id, length = struct.unpack_from(self.header_format, buf, offset)
+                end = offset + self.header_len + length
+                if end > len(buf):
+                    break
+                payload = bytes(buf[offset + self.header_len:end])
+                offset = end
+                if packet_id == SHELL_ID_EXIT:
+                    yield packet_id, bytearray(payload)[0]
+                else:
+                    yield packet_id, payload
+            del buf[:offset]
+
+    def ReadStdout(self):
+        """Yields stdout data until the device closes the stream.
+
+        stderr and the exit code are kept in self.stderr and self.exit_code.
+        """
+        for packet_id, data in self.ReadPackets():
+            if packet_id == SHELL_ID_STDOUT:
+                yield data
+            elif packet_id == SHELL_ID_STDERR:
+                self.stderr += data
+            elif packet_id == SHELL_ID_EXIT:
+                self.exit_code = data
+
+    def ReadResult(self):
+        """Reads the rest of the stream into a ShellResult of bytes."""
+        stdout, stderr, exit_code = [], [], None
+        for packet_id, data in self.ReadPackets():
+            if packet_id == SHELL_ID_STDOUT:
+                stdout.append(data)
+            elif packet_id == SHELL_ID_STDERR:
+                stderr.append(data)
+            elif packet_id == SHELL_ID_EXIT:
+                exit_code = data
+        return ShellResult(b''.join(stdout), b''.join(stderr), exit_code)
+
+
+class LineBuffer(object):
+    """Splits a stream of chunks into lines.
+
+    Text is decoded with an incremental decoder, so multibyte characters split
+    across packets are handled. Only data after the previous scan position is
+    searched for the next newline, not the whole pending line.
+    """
+
+    def __init__(self, encoding='utf8', newline=None, keepends=False, errors='strict'):
+        """Creates the buffer.
+
+        Args:
+          encoding: Encoding of the data, None to yield lines as bytes.
+          newline: The line terminator. None splits on '\n' and also strips a
+              trailing '\r', so PTY output ending lines in '\r\n' works too.
+          keepends: Keep the line terminators.
+          errors: Decoding error handling, see codecs.
+        """
+        self._keepends = keepends
+        self._universal = newline is None
+        sep = newline or '\n'
+        if encoding:
+            self._decoder = codecs.getincrementaldecoder(encoding)(errors)
+            self._sep, self._cr = sep, '\r'
+            self._pending = ''
+        else:
+            self._decoder = None
+            self._sep, self._cr = sep.encode('ascii'), b'\r'
+            self._pending = b''
+        self._scan = 0
+
+    def _Line(self, line):
+        if self._keepends:
+            return line
+        if line.endswith(self._sep):
+            line = line[:-len(self._sep)]
+            if self._universal and line.endswith(self._cr):
+                line = line[:-1]
+        return line
+
+    def feed(self, data):
+        """Adds a chunk, returning the lines it completed."""
+        if self._decoder:
+            data = self._decoder.decode(data)
+        pending = self._pending + data
+        lines = []
+        start = 0
+        while True:
+            end = pending.find(self._sep, self._scan)
+            if end == -1:
+                break
+            end += len(self._sep)
+            lines.append(self._Line(pending[start:end]))
+            start = self._scan = end
+        self._pending = pending[start:]
+        # A separator may straddle this chunk and the next.
+        self._scan = max(len(self._pending) - len(self._sep) + 1, 0)
+        return lines
+
+    def flush(self):
+        """Returns the unterminated last line, if any, and resets the buffer."""
+        pending = self._pending
+        if self._decoder:
+            pending += self._decoder.decode(b'', final=True)
+            self._decoder.reset()
+        self._pending = pending[:0]
+        self._scan = 0
+        return [self._Line(pending)] if pending else []
+
+
+def IterLines(chunks, **kwargs):
+    """Yields the lines of an iterable of bytes chunks, see LineBuffer for kwargs."""
+    buf = LineBuffer(**kwargs)
+    for chunk in chunks:
+        for line in buf.feed(chunk):
+            yield line
+    for line in buf.flush():
+        yield line
+
+
+class CommandOutput(object):
+    """Output of a command, held in memory up to max_memory bytes.
+
+    Larger outputs are spilled to a temporary file, so dumpsys or logcat -d
+    output of hundreds of MB doesn't fill up memory. read() returns the whole
+    output as a string like AdbMessage.Command, iterating yields it in decoded
+    chunks and lines() line by line.
+    """
+
+    read_size = 64 * 1024
+
+    def __init__(self, max_memory=COMMAND_OUTPUT_MAX_MEMORY):
+        self.max_memory = max_memory
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+
+    @property
+    def spilled(self):
+        """Whether the output was written to a temporary file."""
+        return self.size > self.max_memory
+
+    def write(self, data):
+        self._file.seek(0, 2)
+        self._file.write(data)
+        self.size += len(data)
+
+    def read(self):
+        return ''.join(self)
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder('utf8')()
+        self._file.seek(0)
+        while True:
+            data = self._file.read(self.read_size)
+            if not data:
+                break
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def lines(self):
+        """Yields each line of the output, keeping line endings."""
+        self._file.seek(0)
+        for line in self._file:
+            yield line.decode('utf8')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class AdbMessage(object):
     """ADB Protocol and message class.
 
@@ -245,6 +675,9 @@ class AdbMessage(object):
             if not command:
                 raise InvalidCommandError(
                     'Unknown command: %x' % cmd, cmd, (arg0, arg1))
+            # The payload is read even for unexpected commands, otherwise it would
+            # be mistaken for the next header.
+            data = cls._ReadPayload(usb, data_length, data_checksum, timeout_ms)
             if command in expected_cmds:
                 break
 
@@ -253,6 +686,10 @@ class AdbMessage(object):
                     'Never got one of the expected responses (%s)' % expected_cmds,
                     cmd, (timeout_ms, total_timeout_ms))
 
+        return command, arg0, arg1, data
+
+    @classmethod
+    def _ReadPayload(cls, usb, data_length, data_checksum, timeout_ms=None):
         if data_length > 0:
             data = bytearray()
             while data_length > 0:
@@ -270,7 +707,7 @@ class AdbMessage(object):
                     'Received checksum %s != %s', (actual_checksum, data_checksum))
         else:
             data = b''
-        return command, arg0, arg1, bytes(data)
+        return bytes(data)
 
     @classmethod
     def Connect(cls, usb, banner=b'notadb', rsa_keys=None, auth_timeout_ms=100):
@@ -365,26 +802,32 @@ class AdbMessage(object):
         Returns:
           The local connection id.
         """
-        local_id = 1
-        msg = cls(
-            command=b'OPEN', arg0=local_id, arg1=0,
-            data=destination + b'\0')
-        msg.Send(usb, timeout_ms)
-        cmd, remote_id, their_local_id, _ = cls.Read(usb, [b'CLSE', b'OKAY'],
-                                                     timeout_ms=timeout_ms)
-        if local_id != their_local_id:
-            raise InvalidResponseError(
-                'Expected the local_id to be {}, got {}'.format(local_id, their_local_id))
-        if cmd == b'CLSE':
-            # Some devices seem to be sending CLSE once more after a request, this *should* handle it
-            cmd, remote_id, their_local_id, _ = cls.Read(usb, [b'CLSE', b'OKAY'],
-                                                         timeout_ms=timeout_ms)
-            # Device doesn't support this service.
+        router = _StreamRouter.ForHandle(usb)
+        local_id = router.Allocate()
+        try:
+            msg = cls(
+                command=b'OPEN', arg0=local_id, arg1=0,
+                data=destination + b'\0')
+            router.Send(msg, timeout_ms)
+            cmd, remote_id, their_local_id, _ = router.Read(local_id, [b'CLSE', b'OKAY'],
+                                                            timeout_ms=timeout_ms)
+            if local_id != their_local_id:
+                raise InvalidResponseError(
+                    'Expected the local_id to be {}, got {}'.format(local_id, their_local_id))
             if cmd == b'CLSE':
-                return None
-        if cmd != b'OKAY':
-            raise InvalidCommandError('Expected a ready response, got {}'.format(cmd),
-                                      cmd, (remote_id, their_local_id))
+                # Some devices seem to be sending CLSE once more after a request, this *should* handle it
+                cmd, remote_id, their_local_id, _ = router.Read(local_id, [b'CLSE', b'OKAY'],
+                                                                timeout_ms=timeout_ms)
+                # Device doesn't support this service.
+                if cmd == b'CLSE':
+                    router.Release(local_id)
+                    return None
+            if cmd != b'OKAY':
+                raise InvalidCommandError('Expected a ready response, got {}'.format(cmd),
+                                          cmd, (remote_id, their_local_id))
+        except:
+            router.Release(local_id)
+            raise
         return _AdbConnection(usb, local_id, remote_id, timeout_ms)
 
     @classmethod
@@ -402,7 +845,6 @@ class AdbMessage(object):
           timeout_ms: Timeout for USB packets, in milliseconds.
 
         Raises:
-          InterleavedDataError: Multiple streams running over usb.
           InvalidCommandError: Got an unexpected response command.
 
         Returns:
@@ -410,6 +852,33 @@ class AdbMessage(object):
         """
         return ''.join(cls.StreamingCommand(usb, service, command, timeout_ms))
 
+    @classmethod
+    def CaptureCommand(cls, usb, service, command='', timeout_ms=None,
+                       max_memory=COMMAND_OUTPUT_MAX_MEMORY):
+        """Like Command, but with the response captured in a CommandOutput.
+
+        Memory use is bounded by max_memory, larger responses are spilled to a
+        temporary file.
+
+        Args:
+          usb: USB device handle with BulkRead and BulkWrite methods.
+          service: The service on the device to talk to.
+          command: The command to send to the service.
+          timeout_ms: Timeout for USB packets, in milliseconds.
+          max_memory: Bytes of output to hold in memory before spilling.
+
+        Returns:
+          A CommandOutput, to be closed by the caller.
+        """
+        output = CommandOutput(max_memory)
+        try:
+            for data in cls.StreamingRawCommand(usb, service, command, timeout_ms):
+                output.write(data)
+        except:
+            output.close()
+            raise
+        return output
+
     @classmethod
     def StreamingCommand(cls, usb, service, command='', timeout_ms=None):
         """One complete set of USB packets for a single command.
@@ -425,24 +894,108 @@ class AdbMessage(object):
           timeout_ms: Timeout for USB packets, in milliseconds.
 
         Raises:
-          InterleavedDataError: Multiple streams running over usb.
           InvalidCommandError: Got an unexpected response command.
 
         Yields:
           The responses from the service.
         """
+        decoder = codecs.getincrementaldecoder('utf8')()
+        for data in cls.StreamingRawCommand(usb, service, command, timeout_ms):
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    @classmethod
+    def StreamingRawCommand(cls, usb, service, command='', timeout_ms=None):
+        """Like StreamingCommand, but yields the undecoded bytes of each packet.
+
+        If the caller stops iterating early, the connection is closed.
+
+        Args:
+          usb: USB device handle with BulkRead and BulkWrite methods.
+          service: The service on the device to talk to.
+          command: The command to send to the service.
+          timeout_ms: Timeout for USB packets, in milliseconds.
+
+        Yields:
+          The responses from the service, as bytes.
+        """
         if not isinstance(command, bytes):
             command = command.encode('utf8')
         connection = cls.Open(
             usb, destination=b'%s:%s' % (service, command),
             timeout_ms=timeout_ms)
-        for data in connection.ReadUntilClose():
-            yield data.decode('utf8')
+        try:
+            for data in connection.ReadUntilClose():
+                yield data
+        except GeneratorExit:
+            connection.Close()
+            raise
+
+    @classmethod
+    def StreamingInteractiveShellCommand(cls, conn, cmd=None, strip_cmd=True, delim=None, strip_delim=True,
+                                         clean_stdout=True):
+        """Like InteractiveShellCommand, but yields the output as it arrives.
+
+        The delimiter is searched for across packet boundaries. With
+        clean_stdout, output is yielded a line at a time, since a backspace can
+        only erase characters of the current line, and the prompt at the end is
+        yielded last.
+
+        Args:
+          See InteractiveShellCommand. strip_cmd drops the echo of cmd from the
+          first line and strip_delim the delimiter from the last output.
+
+        Yields:
+          The stdout from the shell command, as bytes.
+        """
+        if delim is not None and not isinstance(delim, bytes):
+            delim = delim.encode('utf-8')
+        partial_delim = _PartialDelim(delim)
+        cleaner = _TerminalCleaner() if clean_stdout else None
+        echo = None
+        if cmd:
+            if strip_cmd:
+                echo = str(cmd).encode('utf-8') + b'\r\r\n'
+            # Required. Send a carriage return right after the cmd
+            conn.Write((cmd + '\r').encode('utf8'))
+
+        head = b''
+        tail = b''
+        done = False
+        while not done:
+            _, data = conn.ReadUntil(b'WRTE')
+            if cmd and partial_delim:
+                # Expect multiple WRTE cmds until the delim (usually terminal prompt) is detected
+                window = tail + data
+                done = partial_delim in window
+                tail = window[len(window) - len(partial_delim) + 1:]
+            else:
+                # Otherwise, expect only a single WRTE
+                done = True
+            output = cleaner.feed(data) if cleaner else data
+            if done and cleaner:
+                output += cleaner.flush()
+            if echo is not None:
+                # Hold the output back until the echoed first line is complete.
+                head += output
+                if b'\n' not in head and not done:
+                    continue
+                output = head.replace(echo, b'', 1)
+                echo = None
+            if done and delim and strip_delim:
+                output = output.replace(delim, b'')
+            if output:
+                yield output
 
     @classmethod
     def InteractiveShellCommand(cls, conn, cmd=None, strip_cmd=True, delim=None, strip_delim=True, clean_stdout=True):
         """Retrieves stdout of the current InteractiveShell and sends a shell command if provided
-        TODO: Should we turn this into a yield based function so we can stream all output?
+
+        See StreamingInteractiveShellCommand to stream the output instead.
 
         Args:
           conn: Instance of AdbConnection
@@ -459,85 +1012,13 @@ class AdbMessage(object):
         if delim is not None and not isinstance(delim, bytes):
             delim = delim.encode('utf-8')
 
-        # Delimiter may be shell@hammerhead:/ $
-        # The user or directory could change, making the delimiter somthing like root@hammerhead:/data/local/tmp $
-        # Handle a partial delimiter to search on and clean up
-        if delim:
-            user_pos = delim.find(b'@')
-            dir_pos = delim.rfind(b':/')
-            if user_pos != -1 and dir_pos != -1:
-                partial_delim = delim[user_pos:dir_pos + 1]  # e.g. @hammerhead:
-            else:
-                partial_delim = delim
-        else:
-            partial_delim = None
-
         stdout = ''
-        stdout_stream = BytesIO()
-        original_cmd = ''
+        original_cmd = str(cmd) if cmd else ''
 
         try:
-
-            if cmd:
-                original_cmd = str(cmd)
-                cmd += '\r'  # Required. Send a carriage return right after the cmd
-                cmd = cmd.encode('utf8')
-
-                # Send the cmd raw
-                bytes_written = conn.Write(cmd)
-
-                if delim:
-                    # Expect multiple WRTE cmds until the delim (usually terminal prompt) is detected
-
-                    data = b''
-                    while partial_delim not in data:
-                        cmd, data = conn.ReadUntil(b'WRTE')
-                        stdout_stream.write(data)
-
-                else:
-                    # Otherwise, expect only a single WRTE
-                    cmd, data = conn.ReadUntil(b'WRTE')
-
-                    # WRTE cmd from device will follow with stdout data
-                    stdout_stream.write(data)
-
-            else:
-
-                # No cmd provided means we should just expect a single line from the terminal. Use this sparingly
-                cmd, data = conn.ReadUntil(b'WRTE')
-                if cmd == b'WRTE':
-                    # WRTE cmd from device will follow with stdout data
-                    stdout_stream.write(data)
-                else:
-                    print("Unhandled cmd: {}".format(cmd))
-
-            cleaned_stdout_stream = BytesIO()
-            if clean_stdout:
-                stdout_bytes = stdout_stream.getvalue()
-
-                bsruns = {}  # Backspace runs tracking
-                next_start_pos = 0
-                last_run_pos, last_run_len = find_backspace_runs(stdout_bytes, next_start_pos)
-
-                if last_run_pos != -1 and last_run_len != 0:
-                    bsruns.update({last_run_pos: last_run_len})
-                    cleaned_stdout_stream.write(stdout_bytes[next_start_pos:(last_run_pos - last_run_len)])
-                    next_start_pos += last_run_pos + last_run_len
-
-                while last_run_pos != -1:
-                    last_run_pos, last_run_len = find_backspace_runs(stdout_bytes[next_start_pos:], next_start_pos)
-
-                    if last_run_pos != -1:
-                        bsruns.update({last_run_pos: last_run_len})
-                        cleaned_stdout_stream.write(stdout_bytes[next_start_pos:(last_run_pos - last_run_len)])
-                        next_start_pos += last_run_pos + last_run_len
-
-                cleaned_stdout_stream.write(stdout_bytes[next_start_pos:])
-
-            else:
-                cleaned_stdout_stream.write(stdout_stream.getvalue())
-
-            stdout = cleaned_stdout_stream.getvalue()
+            stdout = b''.join(cls.StreamingInteractiveShellCommand(
+                conn, cmd=cmd, strip_cmd=False, delim=delim, strip_delim=False,
+                clean_stdout=clean_stdout))
 
             # Strip original cmd that will come back in stdout
             if original_cmd and strip_cmd:
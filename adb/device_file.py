@@ -0,0 +1,156 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Seekable, read-only access to device files without pulling them.
+
+Files are read in fixed-size blocks with dd through the exec: service. Blocks
+are kept in an LRU cache, and runs of sequential reads fetch growing ranges of
+blocks ahead in a single dd, so e.g. zipfile.ZipFile only transfers the
+central directory and the members it reads.
+"""
+
+import collections
+import io
+import os
+
+try:
+    from shlex import quote as _ShellQuote
+except ImportError:  # Python 2
+    from pipes import quote as _ShellQuote
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+class DeviceFileReader(io.RawIOBase):
+    """Read-only file object for a device file, see AdbCommands.OpenDeviceFile."""
+
+    def __init__(self, device, path, size, block_size=DEFAULT_BLOCK_SIZE, cache_blocks=32,
+                 max_readahead=16, timeout_ms=None):
+        """Opens the file.
+
+        Args:
+          device: A connected adb_commands.AdbCommands.
+          path: Path of the file on the device.
+          size: Size of the file, from Stat.
+          block_size: Size of the blocks fetched from the device.
+          cache_blocks: Number of blocks kept in memory.
+          max_readahead: Most blocks fetched ahead of sequential reads.
+          timeout_ms: Timeout for USB packets, in milliseconds.
+        """
+        super(DeviceFileReader, self).__init__()
+        self.name = path
+        self.size = size
+        self._device = device
+        self._block_size = block_size
+        self._cache_blocks = max(cache_blocks, max_readahead + 1)
+        self._max_readahead = max_readahead
+        self._timeout_ms = timeout_ms
+        self._blocks = collections.OrderedDict()
+        self._position = 0
+        # The block after the last one read, and how far to read ahead of it.
+        self._next_block = None
+        self._readahead = 0
+        # Number of bytes fetched from the device.
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence %r' % whence)
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
+        self._position = position
+        return position
+
+    def _Fetch(self, first, count):
+        """Reads count blocks from first, none of them cached, into the cache."""
+        data = self._device.ExecOut(
+            'dd if=%s bs=%d skip=%d count=%d 2>/dev/null' % (
+                _ShellQuote(self.name), self._block_size, first, count),
+            timeout_ms=self._timeout_ms)
+        self.bytes_fetched += len(data)
+        for index in range(count):
+            self._blocks[first + index] = data[index * self._block_size:(index + 1) * self._block_size]
+        while len(self._blocks) > self._cache_blocks:
+            self._blocks.popitem(last=False)
+
+    def _Block(self, block, last_block):
+        """Returns the data of block, fetching it and the blocks up to last_block if needed."""
+        data = self._blocks.pop(block, None)
+        if data is not None:
+            self._blocks[block] = data
+            return data
+        if block == self._next_block:
+            self._readahead = min(max(self._readahead * 2, 1), self._max_readahead)
+        else:
+            self._readahead = 0
+        end = min(max(last_block + 1, block + 1 + self._readahead), self._NumBlocks(),
+                  block + self._cache_blocks)
+        # Stop at the first cached block, it's still valid.
+        for index in range(block + 1, end):
+            if index in self._blocks:
+                end = index
+                break
+        self._Fetch(block, end - block)
+        return self._blocks[block]
+
+    def _NumBlocks(self):
+        return (self.size + self._block_size - 1) // self._block_size
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        if end <= self._position:
+            return b''
+        first = self._position // self._block_size
+        last = (end - 1) // self._block_size
+        chunks = []
+        for block in range(first, last + 1):
+            data = self._Block(block, last)
+            start = self._position - block * self._block_size
+            stop = min(end - block * self._block_size, len(data))
+            if start >= stop:
+                # The file shrank since it was opened.
+                break
+            chunks.append(data[start:stop])
+            self._position += stop - start
+        self._next_block = last + 1
+        return b''.join(chunks)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._blocks.clear()
+        super(DeviceFileReader, self).close()
@@ -18,10 +18,21 @@ host side.
 """
 
 import collections
+import mmap
 import os
+import posixpath
 import stat
 import struct
+import sys
+import tarfile
+import threading
 import time
+import zipfile
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 import libusb1
 
@@ -32,6 +43,8 @@ from adb import usb_exceptions
 DEFAULT_PUSH_MODE = stat.S_IFREG | stat.S_IRWXU | stat.S_IRWXG
 # Maximum size of a filesync DATA packet.
 MAX_PUSH_DATA = 2 * 1024
+# Number of chunks buffered between the transfer and the disk I/O threads.
+IO_QUEUE_DEPTH = 64
 
 
 class InvalidChecksumError(Exception):
@@ -54,6 +67,247 @@ DeviceFile = collections.namedtuple('DeviceFile', [
     'filename', 'mode', 'size', 'mtime'])
 
 
+def _RegularFileSize(fileobj):
+    """Returns the size of fileobj if it's backed by a regular file, else None."""
+    try:
+        st = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError, IOError, ValueError):
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+class _MappedFile(object):
+    """Read-only memory map of a regular file, handed out as memoryview slices."""
+
+    # Python 2 mmaps don't support memoryview().
+    supported = sys.version_info[0] >= 3
+
+    def __init__(self, datafile, size):
+        self._map = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self._start = datafile.tell()
+        self._size = size
+
+    def Chunks(self, chunk_size, prefault=False):
+        """Yields slices of the file from its original position.
+
+        Args:
+          chunk_size: Maximum size of each slice.
+          prefault: If True, touch every page of a slice before yielding it, so a
+                    consumer on another thread doesn't stall on page faults.
+        """
+        for offset in range(self._start, self._size, chunk_size):
+            chunk = self._view[offset:offset + chunk_size]
+            if prefault:
+                for i in range(0, len(chunk), mmap.PAGESIZE):
+                    chunk[i]  # pylint: disable=pointless-statement
+            yield chunk
+
+    def Close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # A slice is still referenced, e.g. by a traceback. The map is closed
+            # when it's collected.
+            pass
+
+
+def SafeMemberPath(name):
+    """Returns archive member name as a relative path that stays inside its root."""
+    parts = posixpath.normpath(name).split('/')
+    # normpath only leaves '..' at the start, drop those along with empty parts.
+    return '/'.join(part for part in parts if part not in ('', '.', '..'))
+
+
+def _ReadChunks(datafile, chunk_size):
+    """Yields chunks of datafile until the first empty read."""
+    while True:
+        data = datafile.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+
+class ChunkReader(object):
+    """Minimal read-only file-like object over an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._current = memoryview(b'')
+
+    def read(self, size=-1):
+        parts = []
+        while size < 0 or size > 0:
+            if not self._current:
+                try:
+                    self._current = memoryview(next(self._chunks))
+                except StopIteration:
+                    break
+                continue
+            part = self._current if size < 0 else self._current[:size]
+            self._current = self._current[len(part):]
+            parts.append(bytes(part))
+            if size > 0:
+                size -= len(part)
+        return b''.join(parts)
+
+    def Drain(self):
+        """Consumes whatever the iterable has left."""
+        for _ in self._chunks:
+            pass
+
+
+def _ArchiveMembers(archive):
+    """Yields (name, st_mode, mtime, chunks) for the files of a tar or zip archive.
+
+    Only regular files and symlinks are yielded, the sync protocol creates
+    parent directories on its own.
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            mode = info.external_attr >> 16 or DEFAULT_PUSH_MODE
+            if not stat.S_IFMT(mode):
+                mode |= stat.S_IFREG
+            if not (stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+                continue
+            mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+            with archive.open(info) as member:
+                yield info.filename, mode, mtime, _ReadChunks(member, MAX_PUSH_DATA)
+    else:
+        for info in archive:
+            if info.issym():
+                yield info.name, stat.S_IFLNK | 0o777, int(info.mtime), [info.linkname]
+            elif info.isfile():
+                member = archive.extractfile(info)
+                yield (info.name, stat.S_IFREG | (info.mode & 0o7777), int(info.mtime),
+                       _ReadChunks(member, MAX_PUSH_DATA))
+
+
+class ReaderThread(object):
+    """Produces chunks on a helper thread.
+
+    Iterating yields the chunks of the given iterable in order, which is run on
+    the helper thread at most IO_QUEUE_DEPTH chunks ahead of the consumer.
+    """
+
+    def __init__(self, chunks, depth=IO_QUEUE_DEPTH):
+        self._chunks = chunks
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._Run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _Put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _Run(self):
+        try:
+            for data in self._chunks:
+                if not self._Put(data):
+                    return
+            self._Put(None)
+        except Exception as e:  # pylint: disable=broad-except
+            self._Put(e)
+
+    def __iter__(self):
+        while True:
+            data = self._queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if data is None:
+                return
+            yield data
+
+    def Close(self):
+        self._stopped.set()
+        self._thread.join()
+        # Drop chunks that were never consumed, they may reference a memory map.
+        while not self._queue.empty():
+            self._queue.get()
+
+
+class _MmapWriter(object):
+    """Writes to a regular file through a memory map preallocated to size.
+
+    If more than size bytes are written, the remainder goes through
+    dest_file.write(); on close the file is truncated to the bytes written.
+    """
+
+    def __init__(self, dest_file, size):
+        dest_file.truncate(size)
+        self._dest_file = dest_file
+        self._map = mmap.mmap(dest_file.fileno(), size) if size else None
+        self._offset = 0
+
+    def _CloseMap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def write(self, data):
+        end = self._offset + len(data)
+        if self._map is not None and end <= len(self._map):
+            self._map[self._offset:end] = data
+        else:
+            # The file grew on the device since it was stat'ed.
+            self._CloseMap()
+            self._dest_file.seek(self._offset)
+            self._dest_file.write(data)
+        self._offset = end
+
+    def close(self):
+        self._CloseMap()
+        self._dest_file.truncate(self._offset)
+
+
+class WriterThread(object):
+    """Writes to a file-like object on a helper thread.
+
+    Errors raised by dest_file are re-raised from the next write() or close().
+    """
+
+    def __init__(self, dest_file, depth=IO_QUEUE_DEPTH):
+        self._dest_file = dest_file
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._Run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _Run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self._dest_file.write(data)
+                except Exception as e:  # pylint: disable=broad-except
+                    self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
 class FilesyncProtocol(object):
     """Implements the FileSync protocol as described in sync.txt."""
 
@@ -81,25 +335,195 @@ class FilesyncProtocol(object):
         return files
 
     @classmethod
-    def Pull(cls, connection, filename, dest_file, progress_callback):
-        """Pull a file from the device into the file-like dest_file."""
-        if progress_callback:
+    def Pull(cls, connection, filename, dest_file, progress_callback, overlap_io=False, use_mmap=False):
+        """Pull a file from the device into the file-like dest_file.
+
+        Args:
+          connection: ADB connection
+          filename: Filename to pull from
+          dest_file: File-like object for writing to
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes
+          overlap_io: If True, write to dest_file on a helper thread so slow disks
+                      don't stall reading from the device, also with use_mmap.
+          use_mmap: If True, preallocate dest_file to the size reported by STAT and
+                    copy data straight into a memory map of it. dest_file must be a
+                    regular file opened for reading and writing, e.g. 'w+b'.
+        """
+        if progress_callback or use_mmap:
             total_bytes = cls.Stat(connection, filename)[1]
+        if progress_callback:
             progress = cls._HandleProgress(lambda current: progress_callback(filename, current, total_bytes))
             next(progress)
 
+        # Writers to close once done, innermost last.
+        writers = []
+        writer = dest_file
+        if use_mmap:
+            writer = _MmapWriter(dest_file, total_bytes)
+            writers.insert(0, writer)
+        if overlap_io:
+            writer = WriterThread(writer)
+            writers.insert(0, writer)
+        try:
+            for data in cls.PullIter(connection, filename):
+                writer.write(data)
+                if progress_callback:
+                    progress.send(len(data))
+        except Exception:
+            for writer in writers:
+                try:
+                    writer.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass  # Report the transfer error rather than this one.
+            raise
+        error = None
+        for writer in writers:
+            try:
+                writer.close()
+            except Exception as e:  # pylint: disable=broad-except
+                error = error or e
+        if error is not None:
+            raise error
+
+    @classmethod
+    def PullIter(cls, connection, filename):
+        """Pull a file from the device, yielding its contents as they arrive.
+
+        Only one DATA packet is held in memory at a time, regardless of file size.
+
+        Args:
+          connection: ADB connection
+          filename: Filename to pull from
+
+        Yields:
+          memoryviews over consecutive pieces of the file.
+
+        Raises:
+          PullFailedError: Raised on pull failure.
+        """
         cnxn = FileSyncConnection(connection, b'<2I')
         try:
             cnxn.Send(b'RECV', filename)
             for cmd_id, _, data in cnxn.ReadUntil((b'DATA',), b'DONE'):
                 if cmd_id == b'DONE':
                     break
-                dest_file.write(data)
-                if progress_callback:
-                    progress.send(len(data))
+                yield memoryview(data)
         except usb_exceptions.CommonUsbError as e:
             raise PullFailedError('Unable to pull file %s due to: %s' % (filename, e))
 
+    @classmethod
+    def PushArchive(cls, connection, archive, device_dir, progress_callback=None):
+        """Push the members of an archive to the device without extracting them.
+
+        Member contents, modes and mtimes are streamed straight into SEND requests
+        on one sync connection. Empty directories aren't created.
+
+        Args:
+          connection: ADB connection
+          archive: An open tarfile.TarFile or zipfile.ZipFile. Tar files may be
+                   opened in streaming mode, e.g. 'r|*'.
+          device_dir: Directory on the device to push the members into
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes
+
+        Returns:
+          The list of device paths that were written.
+        """
+        pushed = []
+        for name, mode, mtime, chunks in _ArchiveMembers(archive):
+            filename = posixpath.join(device_dir, SafeMemberPath(name))
+            cls.PushIter(connection, chunks, filename, st_mode=mode, mtime=mtime,
+                         progress_callback=progress_callback)
+            pushed.append(filename)
+        return pushed
+
+    @classmethod
+    def PullArchive(cls, connection, device_path, archive, progress_callback=None):
+        """Pull a device directory tree straight into an archive being written.
+
+        The tree is listed and pulled on one sync connection, files are streamed
+        into the archive without being held in memory. Only directories and
+        regular files are archived, names are relative to device_path.
+
+        Args:
+          connection: ADB connection
+          device_path: Directory on the device to pull
+          archive: A tarfile.TarFile or zipfile.ZipFile open for writing. Tar
+                   files may be opened in streaming mode, e.g. 'w|gz'.
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes
+
+        Returns:
+          The list of archive member names that were written.
+        """
+        written = []
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            list_path = posixpath.join(device_path, relative_dir) if relative_dir else device_path
+            for device_file in cls.List(connection, list_path):
+                basename = bytes(device_file.filename)
+                if not isinstance(basename, str):
+                    # Names aren't necessarily UTF-8, keep them round-trippable.
+                    basename = basename.decode('utf-8', 'surrogateescape')
+                if basename in ('.', '..'):
+                    continue
+                name = posixpath.join(relative_dir, basename)
+                if stat.S_ISDIR(device_file.mode):
+                    cls._AddArchiveMember(archive, name + '/', device_file, None)
+                    pending.append(name)
+                elif stat.S_ISREG(device_file.mode):
+                    filename = posixpath.join(device_path, name)
+                    chunks = cls.PullIter(connection, filename)
+                    if progress_callback:
+                        chunks = cls._ReportProgress(chunks, filename, device_file.size, progress_callback)
+                    cls._AddArchiveMember(archive, name, device_file, chunks)
+                else:
+                    continue
+                written.append(name)
+        return written
+
+    @staticmethod
+    def _AddArchiveMember(archive, name, device_file, chunks):
+        if isinstance(archive, zipfile.ZipFile):
+            if sys.version_info[0] >= 3:
+                # Zip names must be encodable, unlike tar names.
+                name = name.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+            info = zipfile.ZipInfo(name, time.localtime(device_file.mtime)[:6])
+            info.external_attr = device_file.mode << 16
+            if chunks is None:
+                info.external_attr |= 0x10  # MS-DOS directory flag.
+                archive.writestr(info, b'')
+                return
+            info.compress_type = archive.compression
+            if sys.version_info < (3, 6):
+                # Streaming members into a zip needs ZipFile.open(..., 'w').
+                archive.writestr(info, b''.join(bytes(data) for data in chunks))
+                return
+            force_zip64 = device_file.size >= zipfile.ZIP64_LIMIT
+            with archive.open(info, 'w', force_zip64=force_zip64) as member:
+                for data in chunks:
+                    member.write(data)
+        else:
+            info = tarfile.TarInfo(name.rstrip('/'))
+            info.mode = stat.S_IMODE(device_file.mode)
+            info.mtime = device_file.mtime
+            if chunks is None:
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+                return
+            info.size = device_file.size
+            reader = ChunkReader(chunks)
+            archive.addfile(info, reader)
+            # Keep the sync connection in step if the file grew since it was listed.
+            reader.Drain()
+
+    @classmethod
+    def _ReportProgress(cls, chunks, filename, total_bytes, progress_callback):
+        progress = cls._HandleProgress(lambda current: progress_callback(filename, current, total_bytes))
+        next(progress)
+        for data in chunks:
+            progress.send(len(data))
+            yield data
+
     @classmethod
     def _HandleProgress(cls, progress_callback):
         """Calls the callback with the current progress and total bytes written/received.
@@ -118,7 +542,7 @@ class FilesyncProtocol(object):
 
     @classmethod
     def Push(cls, connection, datafile, filename,
-             st_mode=DEFAULT_PUSH_MODE, mtime=0, progress_callback=None):
+             st_mode=DEFAULT_PUSH_MODE, mtime=0, progress_callback=None, overlap_io=False):
         """Push a file-like object to the device.
 
         Args:
@@ -128,30 +552,73 @@ class FilesyncProtocol(object):
           st_mode: stat mode for filename
           mtime: modification time
           progress_callback: callback method that accepts filename, bytes_written and total_bytes
+          overlap_io: If True, read datafile on a helper thread so slow disks
+                      don't stall writing to the device. Memory-mapped regular
+                      files are paged in by the helper thread instead.
 
         Raises:
           PushFailedError: Raised on push failure.
         """
+        file_size = _RegularFileSize(datafile)
+        mapped = reader = None
+        if file_size and _MappedFile.supported:
+            # Regular files are sent straight from a memory map, without copies.
+            mapped = _MappedFile(datafile, file_size)
+            chunks = mapped.Chunks(MAX_PUSH_DATA, prefault=overlap_io)
+        else:
+            chunks = _ReadChunks(datafile, MAX_PUSH_DATA)
+        if overlap_io:
+            chunks = reader = ReaderThread(chunks)
+        try:
+            cls.PushIter(connection, chunks, filename, st_mode=st_mode, mtime=mtime,
+                         progress_callback=progress_callback,
+                         total_bytes=file_size if file_size is not None else -1)
+        finally:
+            if reader:
+                reader.Close()
+            chunks = None
+            if mapped:
+                mapped.Close()
+
+    @classmethod
+    def PushIter(cls, connection, chunks, filename,
+                 st_mode=DEFAULT_PUSH_MODE, mtime=0, progress_callback=None, total_bytes=-1):
+        """Push data produced by an iterable to the device.
+
+        Chunks are sent as they are produced, so memory use doesn't depend on the
+        size of the file.
+
+        Args:
+          connection: ADB connection
+          chunks: Iterable of bytes-like objects making up the file contents
+          filename: Filename to push to
+          st_mode: stat mode for filename
+          mtime: modification time
+          progress_callback: callback method that accepts filename, bytes_written and total_bytes
+          total_bytes: total_bytes to report to progress_callback, -1 if unknown
 
+        Raises:
+          PushFailedError: Raised on push failure.
+        """
         fileinfo = ('{},{}'.format(filename, int(st_mode))).encode('utf-8')
 
         cnxn = FileSyncConnection(connection, b'<2I')
         cnxn.Send(b'SEND', fileinfo)
 
         if progress_callback:
-            total_bytes = os.fstat(datafile.fileno()).st_size if isinstance(datafile, file) else -1
             progress = cls._HandleProgress(lambda current: progress_callback(filename, current, total_bytes))
             next(progress)
 
-        while True:
-            data = datafile.read(MAX_PUSH_DATA)
-            if data:
+        for chunk in chunks:
+            if isinstance(chunk, str) and not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf8')
+            view = memoryview(chunk)
+            for offset in range(0, len(view), MAX_PUSH_DATA):
+                data = view[offset:offset + MAX_PUSH_DATA]
                 cnxn.Send(b'DATA', data)
 
                 if progress_callback:
                     progress.send(len(data))
-            else:
-                break
 
         if mtime == 0:
             mtime = int(time.time())
@@ -199,15 +666,18 @@ class FileSyncConnection(object):
           size: Optionally override size from len(data).
         """
         if data:
-            if not isinstance(data, bytes):
-                data = data.encode('utf8')
+            if not isinstance(data, (bytes, bytearray, memoryview)):
+                data = data.encode('utf8', 'surrogateescape')
             size = len(data)
 
         if not self._CanAddToSendBuffer(len(data)):
             self._Flush()
-        buf = struct.pack(b'<2I', self.id_to_wire[command_id], size) + data
-        self.send_buffer[self.send_idx:self.send_idx + len(buf)] = buf
-        self.send_idx += len(buf)
+        # Pack straight into the send buffer so data (possibly a memoryview) is
+        # copied exactly once.
+        struct.pack_into(b'<2I', self.send_buffer, self.send_idx, self.id_to_wire[command_id], size)
+        self.send_idx += self.send_header_len
+        self.send_buffer[self.send_idx:self.send_idx + len(data)] = data
+        self.send_idx += len(data)
 
     def Read(self, expected_ids, read_data=True):
         """Read ADB messages and return FileSync packets."""
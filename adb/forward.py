@@ -0,0 +1,207 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Forwarding local TCP connections to device services, like adb forward.
+
+Each accepted connection gets its own ADB stream and a pair of threads, one
+per direction. A stream has at most one packet in flight each way: we send
+the next packet of socket data once the device acked the last one, and ack
+the device's packets as we read them, which we only do once the previous one
+was written to the socket. A slow socket or service so only holds up its own
+stream, while the others keep sharing the transport.
+"""
+
+import socket
+import threading
+
+import libusb1
+
+from adb import adb_protocol
+from adb import usb_exceptions
+
+
+def _IsTimeout(error):
+    if isinstance(error, usb_exceptions.TcpTimeoutException):
+        return True
+    return (isinstance(error, usb_exceptions.ReadFailedError) and
+            isinstance(error.usb_error, libusb1.USBErrorTimeout))
+
+
+class _ForwardedConnection(object):
+    """Pumps data between an accepted socket and its ADB stream."""
+
+    def __init__(self, client, connection):
+        self.client = client
+        self.connection = connection
+        self._okay = threading.Event()
+        self._okay.set()
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def _Close(self):
+        """Closes our end of the stream once, the device answers with CLSE."""
+        with self._lock:
+            if self._closing:
+                return
+            self._closing = True
+        try:
+            self.connection.SendClose()
+        except usb_exceptions.CommonUsbError:
+            pass
+
+    def SocketToDevice(self):
+        try:
+            while True:
+                data = self.client.recv(adb_protocol.MAX_ADB_DATA)
+                if not data:
+                    break
+                self._okay.wait()
+                if self._closing:
+                    break
+                self._okay.clear()
+                self.connection.Send(data)
+        except (socket.error, usb_exceptions.CommonUsbError):
+            pass
+        finally:
+            self._Close()
+
+    def DeviceToSocket(self):
+        try:
+            while True:
+                try:
+                    cmd, data = self.connection.ReadUntil(b'WRTE', b'OKAY', b'CLSE')
+                except usb_exceptions.CommonUsbError as e:
+                    if _IsTimeout(e):
+                        # The stream is idle, not broken.
+                        continue
+                    raise
+                if cmd == b'WRTE':
+                    try:
+                        self.client.sendall(data)
+                    except socket.error:
+                        self._Close()
+                elif cmd == b'OKAY':
+                    self._okay.set()
+                elif cmd == b'CLSE':
+                    self._Close()
+                    return
+        finally:
+            self._closing = True
+            self._okay.set()
+            try:
+                self.client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.client.close()
+
+
+class ForwardServer(object):
+    """Listens on a local TCP port, forwarding each connection to a device service."""
+
+    def __init__(self, usb, remote, local_port=0, host='127.0.0.1', backlog=16, timeout_ms=None,
+                 close_callback=None):
+        """Starts listening.
+
+        Args:
+          usb: USB device handle with BulkRead and BulkWrite methods.
+          remote: Device service to open for each connection, e.g. b'tcp:8080'
+              or b'localabstract:name'.
+          local_port: Local port to listen on, 0 for any free port.
+          host: Local address to listen on.
+          backlog: Maximum number of connections waiting to be accepted.
+          timeout_ms: Timeout for USB packets, in milliseconds. Idle streams
+              keep waiting after it.
+          close_callback: Called with the server the first time it's closed.
+        """
+        self._usb = usb
+        self._remote = remote
+        self._timeout_ms = timeout_ms
+        self._close_callback = close_callback
+        self._lock = threading.Lock()
+        self._forwarded = set()
+        self._closed = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, local_port))
+        self._socket.listen(backlog)
+        # Closing the socket doesn't wake up accept everywhere, so poll.
+        self._socket.settimeout(0.1)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._Accept)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.Close()
+
+    def _Accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except socket.timeout:
+                if self._closed:
+                    return
+                continue
+            except socket.error:
+                if self._closed:
+                    return
+                raise
+            client.settimeout(None)
+            thread = threading.Thread(target=self._Forward, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _Forward(self, client):
+        try:
+            connection = adb_protocol.AdbMessage.Open(self._usb, self._remote, timeout_ms=self._timeout_ms)
+        except usb_exceptions.CommonUsbError:
+            connection = None
+        if connection is None:
+            client.close()
+            return
+        forwarded = _ForwardedConnection(client, connection)
+        with self._lock:
+            if self._closed:
+                forwarded.client.close()
+                connection.SendClose()
+                return
+            self._forwarded.add(forwarded)
+        writer = threading.Thread(target=forwarded.SocketToDevice)
+        writer.daemon = True
+        writer.start()
+        try:
+            forwarded.DeviceToSocket()
+        finally:
+            writer.join()
+            with self._lock:
+                self._forwarded.discard(forwarded)
+
+    def Close(self):
+        """Stops listening and closes the forwarded connections."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            forwarded = list(self._forwarded)
+        self._socket.close()
+        if self._close_callback:
+            self._close_callback(self)
+        for connection in forwarded:
+            try:
+                # Wakes up the socket reader, which closes the stream.
+                connection.client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
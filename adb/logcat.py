@@ -0,0 +1,318 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Structured logcat output.
+
+Parses the binary format of logcat -B, a stream of logger_entry records from
+android's log/log_read.h, instead of regex-parsing text lines.
+"""
+
+import collections
+import gzip
+import heapq
+import os
+import struct
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from adb import filesync_protocol
+from adb import usb_exceptions
+
+
+# Log priorities, from android/log.h.
+VERBOSE = 2
+DEBUG = 3
+INFO = 4
+WARN = 5
+ERROR = 6
+FATAL = 7
+
+LogEntry = collections.namedtuple(
+    'LogEntry', ['pid', 'tid', 'sec', 'nsec', 'priority', 'tag', 'message'])
+
+# An entry of MergeLogcat and the name of the device it came from.
+MergedEntry = collections.namedtuple('MergedEntry', ['device', 'entry'])
+
+_PRIORITY_LETTERS = {VERBOSE: 'V', DEBUG: 'D', INFO: 'I', WARN: 'W', ERROR: 'E', FATAL: 'F'}
+
+# len, hdr_size, pid, tid, sec, nsec. Later versions append fields, given by
+# hdr_size, which is 0 in version 1.
+_HEADER = struct.Struct(b'<HHiIii')
+
+
+def ParseBinaryLog(chunks, tags=None, min_priority=None):
+    """Yields the entries of logcat -B output.
+
+    Entries are filtered on their raw bytes, so the tag and message of
+    filtered out entries are never decoded.
+
+    Args:
+      chunks: Iterable of bytes, e.g. AdbCommands.StreamingExec output.
+      tags: Only yield entries with one of these tags.
+      min_priority: Only yield entries of at least this priority, e.g. WARN.
+
+    Yields:
+      LogEntry tuples, with the tag and message as strings.
+    """
+    if tags is not None:
+        tags = set(tag if isinstance(tag, bytes) else tag.encode('utf8') for tag in tags)
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        offset = 0
+        while len(buf) - offset >= _HEADER.size:
+            length, header_size, pid, tid, sec, nsec = _HEADER.unpack_from(buf, offset)
+            start = offset + (header_size or _HEADER.size)
+            end = start + length
+            if end > len(buf):
+                break
+            offset = end
+            if length == 0:
+                continue
+            priority = buf[start]
+            if min_priority is not None and priority < min_priority:
+                continue
+            tag_end = buf.find(b'\0', start + 1, end)
+            if tag_end == -1:
+                tag_end = end
+            tag = bytes(buf[start + 1:tag_end])
+            if tags is not None and tag not in tags:
+                continue
+            message = bytes(buf[tag_end + 1:end]).rstrip(b'\0').rstrip(b'\n')
+            yield LogEntry(pid, tid, sec, nsec, priority,
+                           tag.decode('utf8', 'replace'), message.decode('utf8', 'replace'))
+        del buf[:offset]
+
+
+def FormatEntry(entry):
+    """Formats an entry as a line like logcat -v epoch, with nanoseconds."""
+    return '%d.%09d %5d %5d %s %s: %s\n' % (
+        entry.sec, entry.nsec, entry.pid, entry.tid,
+        _PRIORITY_LETTERS.get(entry.priority, '?'), entry.tag, entry.message)
+
+
+class _RotatingFile(object):
+    """File-like object writing to numbered files, rotated by size or age.
+
+    Files are named path.1, path.2, ... with .gz appended when compressed, and
+    only the newest keep_files are kept.
+    """
+
+    def __init__(self, path, max_bytes=None, max_age_s=None, compress=False, keep_files=None):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age_s = max_age_s
+        self._compress = compress
+        self._keep_files = keep_files
+        self._index = 0
+        self._file = None
+        self._opened = None
+        self._size = 0
+        self.paths = []
+
+    def _Open(self):
+        self._index += 1
+        path = '%s.%d' % (self._path, self._index)
+        if self._compress:
+            path += '.gz'
+            self._file = gzip.open(path, 'wb')
+        else:
+            self._file = open(path, 'wb')
+        self._opened = time.time()
+        self._size = 0
+        self.paths.append(path)
+        if self._keep_files and len(self.paths) > self._keep_files:
+            os.remove(self.paths.pop(0))
+
+    def write(self, data):
+        if self._file is not None and (
+                (self._max_bytes and self._size + len(data) > self._max_bytes) or
+                (self._max_age_s and time.time() - self._opened >= self._max_age_s)):
+            self.close()
+        if self._file is None:
+            self._Open()
+        self._file.write(data)
+        self._size += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LogcatCapture(object):
+    """Captures a device's logcat to rotated files, across reconnects.
+
+    Entries are read in binary form and written as FormatEntry lines through a
+    bounded queue drained by a writer thread. When the disk stalls the queue
+    fills up and reading from the device stops, applying backpressure to the
+    ADB stream instead of growing memory. After a reconnect, logcat resumes
+    with -T from the timestamp of the last entry written, and entries already
+    written at that timestamp are skipped, so nothing is lost or duplicated.
+    """
+
+    def __init__(self, device, path, options='', max_bytes=64 * 1024 * 1024, max_age_s=None,
+                 compress=False, keep_files=None, reconnect=None, retry_delay_s=1.0,
+                 depth=filesync_protocol.IO_QUEUE_DEPTH, timeout_ms=None):
+        """Creates the capture.
+
+        Args:
+          device: A connected adb_commands.AdbCommands.
+          path: Prefix of the capture files, see _RotatingFile.
+          options: Further arguments to pass to 'logcat'.
+          max_bytes: Rotate files at this size, None for no limit.
+          max_age_s: Rotate files after this many seconds, None for no limit.
+          compress: Write gzip compressed files.
+          keep_files: Delete all but the newest keep_files files.
+          reconnect: Callable returning a newly connected AdbCommands after a
+              USB error, None to raise the error instead.
+          retry_delay_s: Time to wait before reconnecting.
+          depth: Number of entries buffered for the writer thread.
+          timeout_ms: Maximum time to wait for each packet of output.
+        """
+        self._device = device
+        self._options = options
+        self._reconnect = reconnect
+        self._retry_delay_s = retry_delay_s
+        self._depth = depth
+        self._timeout_ms = timeout_ms
+        self.file = _RotatingFile(path, max_bytes=max_bytes, max_age_s=max_age_s,
+                                  compress=compress, keep_files=keep_files)
+        self._stopped = False
+        # Timestamp of the last entry written and the entries written at it.
+        self._last_time = None
+        self._last_entries = set()
+        self._resuming = False
+
+    def _IsNew(self, entry):
+        timestamp = (entry.sec, entry.nsec)
+        if self._resuming:
+            # -T repeats the entries at the timestamp it was given.
+            if timestamp < self._last_time or (
+                    timestamp == self._last_time and entry in self._last_entries):
+                return False
+            self._resuming = False
+        if timestamp != self._last_time:
+            self._last_time = timestamp
+            self._last_entries = set()
+        self._last_entries.add(entry)
+        return True
+
+    def _Options(self):
+        if self._last_time is None:
+            return self._options
+        return '%s -T %d.%09d' % (self._options, self._last_time[0], self._last_time[1])
+
+    def Run(self):
+        """Captures until Stop is called or logcat ends, e.g. with -d."""
+        writer = filesync_protocol.WriterThread(self.file, depth=self._depth)
+        try:
+            while not self._stopped:
+                try:
+                    for entry in self._device.BinaryLogcat(self._Options(), timeout_ms=self._timeout_ms):
+                        if self._IsNew(entry):
+                            writer.write(FormatEntry(entry).encode('utf8'))
+                        if self._stopped:
+                            break
+                    return
+                except usb_exceptions.CommonUsbError:
+                    if self._reconnect is None:
+                        raise
+                    time.sleep(self._retry_delay_s)
+                    self._device = self._reconnect()
+                    self._resuming = self._last_time is not None
+        finally:
+            try:
+                writer.close()
+            finally:
+                self.file.close()
+
+    def Stop(self):
+        """Makes Run return after the next entry."""
+        self._stopped = True
+
+
+def MergeLogcat(devices, options='', window_s=1.0, depth=filesync_protocol.IO_QUEUE_DEPTH, timeout_ms=None):
+    """Yields the logcat entries of several devices as one time-ordered stream.
+
+    Each device's BinaryLogcat runs on its own thread into a shared bounded
+    queue. Entries are merged through a heap and yielded once they are
+    window_s older than the newest entry seen, so entries arriving up to
+    window_s late are still put in order and memory use only depends on the
+    entry rate, not on how long the merge runs.
+
+    Args:
+      devices: Dict of device name to connected adb_commands.AdbCommands.
+      options: Further arguments to pass to 'logcat'.
+      window_s: How late an entry may arrive and still be put in order.
+      depth: Number of entries buffered between the device threads and the merge.
+      timeout_ms: Maximum time to wait for each packet of output.
+
+    Yields:
+      MergedEntry tuples.
+    """
+    entries = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def Put(item):
+        while not stopped.is_set():
+            try:
+                entries.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Read(name, device):
+        try:
+            for entry in device.BinaryLogcat(options, timeout_ms=timeout_ms):
+                if not Put((name, entry)):
+                    return
+            Put((name, None))
+        except Exception as e:  # pylint: disable=broad-except
+            Put((name, e))
+
+    threads = [threading.Thread(target=Read, args=item) for item in devices.items()]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    window_ns = int(window_s * 1e9)
+    heap = []
+    # Keeps the order of entries with the same timestamp.
+    count = 0
+    newest = None
+    running = len(threads)
+    try:
+        while running:
+            name, entry = entries.get()
+            if entry is None:
+                running -= 1
+                continue
+            if isinstance(entry, Exception):
+                raise entry
+            timestamp = entry.sec * 1000000000 + entry.nsec
+            heapq.heappush(heap, (timestamp, count, MergedEntry(name, entry)))
+            count += 1
+            newest = timestamp if newest is None else max(newest, timestamp)
+            while heap[0][0] <= newest - window_ns:
+                yield heapq.heappop(heap)[2]
+        while heap:
+            yield heapq.heappop(heap)[2]
+    finally:
+        stopped.set()
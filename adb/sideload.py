@@ -0,0 +1,188 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Serving an OTA package to a device in recovery, like adb sideload.
+
+The device opens nothing itself: we open sideload-host:<size>:<block size>
+and it then writes the number of each block it wants as 8 ASCII digits, in
+any order and possibly more than once, until it writes DONEDONE or FAILFAIL.
+"""
+
+import collections
+import mmap
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from adb import adb_protocol
+from adb import usb_exceptions
+
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+_REQUEST_LEN = 8
+_DONE = b'DONEDONE'
+_FAIL = b'FAILFAIL'
+
+
+class SideloadFailedError(usb_exceptions.AdbCommandFailureException):
+    """The device reported that installing the package failed."""
+
+
+class _BlockCache(object):
+    """LRU cache of the blocks of a memory mapped package.
+
+    Blocks the device is likely to ask for next are copied out of the map on a
+    helper thread, so page faults on the package overlap with USB transfers.
+    """
+
+    def __init__(self, package, size, block_size, max_blocks, prefetch):
+        self._map = mmap.mmap(package.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._size = size
+        self._block_size = block_size
+        self._max_blocks = max(max_blocks, prefetch + 1)
+        self._prefetch = prefetch
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict()
+        # Prefetches are dropped rather than queued when the helper falls behind.
+        self._requests = queue.Queue(maxsize=max(prefetch * 2, 1))
+        self._thread = None
+        if prefetch:
+            self._thread = threading.Thread(target=self._Prefetch)
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def num_blocks(self):
+        return (self._size + self._block_size - 1) // self._block_size
+
+    def _Read(self, block):
+        offset = block * self._block_size
+        return self._map[offset:offset + self._block_size]
+
+    def _Put(self, block, data):
+        with self._lock:
+            self._blocks[block] = data
+            while len(self._blocks) > self._max_blocks:
+                self._blocks.popitem(last=False)
+
+    def _Prefetch(self):
+        while True:
+            block = self._requests.get()
+            if block is None:
+                return
+            with self._lock:
+                if block in self._blocks:
+                    continue
+            self._Put(block, self._Read(block))
+
+    def Get(self, block):
+        """Returns the data of block, queueing the blocks after it for prefetch."""
+        if not 0 <= block < self.num_blocks:
+            raise adb_protocol.InvalidResponseError(
+                'Device requested block %d of %d' % (block, self.num_blocks))
+        with self._lock:
+            data = self._blocks.pop(block, None)
+            if data is not None:
+                self._blocks[block] = data
+        if data is None:
+            data = self._Read(block)
+            self._Put(block, data)
+        for next_block in range(block + 1, min(block + 1 + self._prefetch, self.num_blocks)):
+            try:
+                self._requests.put_nowait(next_block)
+            except queue.Full:
+                break
+        return data
+
+    def Close(self):
+        if self._thread:
+            # Blocks until the helper makes room, it never waits on us.
+            self._requests.put(None)
+            self._thread.join()
+        if self._size:
+            self._map.close()
+
+
+def Sideload(usb, path, block_size=DEFAULT_BLOCK_SIZE, cache_blocks=16, prefetch=2,
+             progress_callback=None, timeout_ms=None):
+    """Serves the package at path to a device in sideload mode until it's done.
+
+    Args:
+      usb: USB device handle with BulkRead and BulkWrite methods.
+      path: Local path of the OTA package.
+      block_size: Size of the blocks the device requests.
+      cache_blocks: Number of recently served blocks kept in memory.
+      prefetch: Number of blocks after each requested one read ahead.
+      progress_callback: callback method that accepts path, blocks_served and
+                         total_blocks. Blocks requested again count again.
+      timeout_ms: Timeout for USB packets, in milliseconds.
+
+    Raises:
+      SideloadFailedError: The device failed to install the package.
+      usb_exceptions.AdbCommandFailureException: The device isn't in
+        sideload mode, or closed the stream before it was done.
+    """
+    size = os.path.getsize(path)
+    connection = adb_protocol.AdbMessage.Open(
+        usb, b'sideload-host:%d:%d' % (size, block_size), timeout_ms=timeout_ms)
+    if connection is None:
+        raise usb_exceptions.AdbCommandFailureException('Device does not support sideload-host')
+
+    with open(path, 'rb') as package:
+        cache = _BlockCache(package, size, block_size, cache_blocks, prefetch)
+        try:
+            _Serve(connection, cache, path, progress_callback)
+        except:
+            # Close the stream on errors too, so its local id is released.
+            try:
+                connection.Close()
+            except Exception:  # pylint: disable=broad-except
+                pass  # Report the first error rather than this one.
+            raise
+        finally:
+            cache.Close()
+    connection.Close()
+
+
+def _Serve(connection, cache, path, progress_callback):
+    """Answers the device's block requests until it writes DONEDONE."""
+    buf = bytearray()
+    served = 0
+    while True:
+        cmd, data = connection.ReadUntil(b'WRTE', b'CLSE')
+        if cmd == b'CLSE':
+            raise usb_exceptions.AdbCommandFailureException(
+                'Device closed the sideload stream after %d blocks' % served)
+        buf += data
+        while len(buf) >= _REQUEST_LEN:
+            request = bytes(buf[:_REQUEST_LEN])
+            del buf[:_REQUEST_LEN]
+            if request == _DONE:
+                return
+            if request == _FAIL:
+                raise SideloadFailedError('Device failed to install %s' % path)
+            try:
+                block = int(request)
+            except ValueError:
+                raise adb_protocol.InvalidResponseError('Bad sideload request %r' % request)
+            data = cache.Get(block)
+            for offset in range(0, len(data), adb_protocol.MAX_ADB_DATA):
+                connection.Write(data[offset:offset + adb_protocol.MAX_ADB_DATA])
+            served += 1
+            if progress_callback:
+                progress_callback(path, served, cache.num_blocks)
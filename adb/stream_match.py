@@ -0,0 +1,207 @@
+# Copyright 2014 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Waiting for any of several patterns in a streaming command's output.
+
+Literal patterns are compiled into a single Aho-Corasick automaton and regex
+patterns into a single alternation, so each chunk of output is scanned once
+however many patterns there are.
+"""
+
+import codecs
+import collections
+import re
+import time
+
+
+# The pattern that matched, the matched text and the line it was found on.
+Match = collections.namedtuple('Match', ['pattern', 'text', 'context'])
+
+
+class _AhoCorasick(object):
+    """Aho-Corasick automaton over the characters of a set of literals.
+
+    The current state is kept between calls to Search, so matches spanning
+    chunk boundaries are found.
+    """
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        # Indexes of the words ending at each state.
+        self._out = [()]
+        for index, word in enumerate(words):
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._out[state] += (index,)
+
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._out[next_state] += self._out[fail]
+        self.state = 0
+
+    def Search(self, text):
+        """Returns (end, word index) of the first match ending in text, or None."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = self.state
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                self.state = state
+                return end, out[state][0]
+        self.state = state
+        return None
+
+
+class MultiPatternMatcher(object):
+    """Finds the first of several patterns in text fed a chunk at a time.
+
+    Literals (str or bytes) match anywhere, across chunk boundaries. Regexes
+    (compiled with re.compile) are matched against each complete line.
+    """
+
+    def __init__(self, patterns):
+        self._literals = []
+        self._regexes = []
+        for pattern in patterns:
+            if isinstance(pattern, bytes):
+                self._literals.append((pattern, pattern.decode('utf8')))
+            elif isinstance(pattern, str):
+                self._literals.append((pattern, pattern))
+            else:
+                self._regexes.append(pattern)
+        if any(not text for _, text in self._literals):
+            raise ValueError('Empty literal pattern')
+        self._automaton = _AhoCorasick([text for _, text in self._literals])
+
+        # Regexes without groups are combined into one alternation. Combining
+        # renumbers groups, which would break backreferences, so regexes with
+        # groups are searched one at a time.
+        self._combined = None
+        self._combinable = [regex for regex in self._regexes if not regex.groups]
+        self._separate = [regex for regex in self._regexes if regex.groups]
+        flags = set(regex.flags for regex in self._combinable)
+        if len(flags) == 1 and len(self._combinable) > 1:
+            self._combined = re.compile('|'.join(
+                '(?P<_p%d>%s)' % (i, regex.pattern) for i, regex in enumerate(self._combinable)),
+                flags.pop())
+        else:
+            self._separate = self._regexes
+
+        self._decoder = codecs.getincrementaldecoder('utf8')('replace')
+        # The start of the current line, fed but not terminated yet.
+        self._line = ''
+
+    def _SearchLine(self, line):
+        """Returns (end, Match) of the first regex match in line, or None."""
+        found = None
+        if self._combined:
+            match = self._combined.search(line)
+            if match:
+                found = match.end(), Match(self._combinable[int(match.lastgroup[2:])], match.group(), line)
+        for regex in self._separate:
+            match = regex.search(line)
+            if match and (found is None or match.end() < found[0]):
+                found = match.end(), Match(regex, match.group(), line)
+        return found
+
+    def feed(self, data):
+        """Adds a chunk of str or bytes output, returning the first Match in it or None."""
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        pending = self._line + data
+        # (end offset in pending, Match) of the earliest match so far.
+        found = None
+        if self._literals:
+            literal = self._automaton.Search(data)
+            if literal:
+                end = len(self._line) + literal[0] + 1
+                pattern, text = self._literals[literal[1]]
+                line_start = pending.rfind('\n', 0, end - 1) + 1
+                line_end = pending.find('\n', end - 1)
+                if line_end == -1:
+                    line_end = len(pending)
+                found = end, Match(pattern, text, pending[line_start:line_end].rstrip('\r'))
+        if self._regexes:
+            offset = 0
+            while True:
+                newline = pending.find('\n', offset)
+                if newline == -1 or (found and offset >= found[0]):
+                    break
+                line_match = self._SearchLine(pending[offset:newline].rstrip('\r'))
+                if line_match and (found is None or offset + line_match[0] <= found[0]):
+                    found = offset + line_match[0], line_match[1]
+                    break
+                offset = newline + 1
+        self._line = pending[pending.rfind('\n') + 1:]
+        return found and found[1]
+
+    def flush(self):
+        """Matches the regexes against the last, unterminated line."""
+        line, self._line = self._line + self._decoder.decode(b'', final=True), ''
+        if self._regexes and line:
+            line_match = self._SearchLine(line.rstrip('\r'))
+            if line_match:
+                return line_match[1]
+        return None
+
+
+def WaitFor(stream, patterns, timeout_s=None):
+    """Returns the first match of any of patterns in stream.
+
+    The stream is closed once a match is found, the timeout expires or it ends,
+    which for the streaming commands of AdbCommands stops the device command.
+    The timeout is checked as chunks arrive, use the stream's timeout_ms to
+    bound the wait for a quiet device.
+
+    Args:
+      stream: Iterable of str or bytes chunks, e.g. AdbCommands.Logcat output.
+      patterns: Literal strings and compiled regexes, see MultiPatternMatcher.
+      timeout_s: Give up after this many seconds.
+
+    Returns:
+      A Match of the pattern, matched text and its line, or None if the stream
+      ended or the timeout expired first.
+    """
+    matcher = MultiPatternMatcher(patterns)
+    deadline = None if timeout_s is None else time.time() + timeout_s
+    try:
+        for chunk in stream:
+            match = matcher.feed(chunk)
+            if match:
+                return match
+            if deadline is not None and time.time() > deadline:
+                return None
+        return matcher.flush()
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
@@ -15,14 +15,28 @@
 """Tests for adb."""
 
 from io import BytesIO
+import hashlib
+import os
+import re
+import shutil
+import socket
 import struct
+import tarfile
+import tempfile
+import time
 import unittest
+import zipfile
 from mock import mock
 
 
 from adb import common
 from adb import adb_commands
 from adb import adb_protocol
+from adb import filesync_protocol
+from adb import logcat
+from adb import sideload
+from adb import stream_match
+from adb import usb_exceptions
 from adb.usb_exceptions import TcpTimeoutException, DeviceNotFoundError
 import common_stub
 
@@ -61,9 +75,10 @@ class BaseAdbTest(unittest.TestCase):
     return struct.pack(b'<6I', command, arg0, arg1, len(data), checksum, magic)
 
   @classmethod
-  def _ExpectConnection(cls, usb):
+  def _ExpectConnection(cls, usb, features=b''):
     cls._ExpectWrite(usb, b'CNXN', 0x01000000, 4096, b'host::%s\0' % BANNER)
-    cls._ExpectRead(usb, b'CNXN', 0, 0, b'device::\0')
+    cls._ExpectRead(usb, b'CNXN', 0, 0,
+                    b'device::features=%s\0' % features if features else b'device::\0')
 
   @classmethod
   def _ExpectOpen(cls, usb, service):
@@ -82,9 +97,9 @@ class BaseAdbTest(unittest.TestCase):
 
 class AdbTest(BaseAdbTest):
   @classmethod
-  def _ExpectCommand(cls, service, command, *responses):
+  def _ExpectCommand(cls, service, command, *responses, **kwargs):
     usb = common_stub.StubUsb(device=None, setting=None)
-    cls._ExpectConnection(usb)
+    cls._ExpectConnection(usb, features=kwargs.get('features', b''))
     cls._ExpectOpen(usb, b'%s:%s\0' % (service, command))
 
     for response in responses:
@@ -99,6 +114,37 @@ class AdbTest(BaseAdbTest):
     dev = adb_commands.AdbCommands()
     dev.ConnectDevice(handle=usb, banner=BANNER)
 
+  def testGetProp(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectWrite(usb, b'CNXN', 0x01000000, 4096, b'host::%s\0' % BANNER)
+    self._ExpectRead(usb, b'CNXN', 0, 0,
+                     b'device::ro.product.model=Pixel;ro.product.name=p;features=shell_v2,cmd\0')
+    self._ExpectOpen(usb, b'shell:getprop\0')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, 0,
+                     b'[ro.build.version.sdk]: [30]\r\n[multi.line]: [a\r\nb]\r\n[empty]: []\r\n')
+    self._ExpectClose(usb)
+    self._ExpectOpen(usb, b'shell:getprop\0')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, 0, b'[ro.product.model]: [Pixel 2]\r\n')
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual({'ro.product.model': 'Pixel', 'ro.product.name': 'p'}, dev.build_props)
+    self.assertEqual({'shell_v2', 'cmd'}, dev.features)
+    self.assertEqual('Pixel', dev.GetProp('ro.product.model'))
+    self.assertEqual('30', dev.GetProp('ro.build.version.sdk'))
+    # Answered from the properties loaded above.
+    self.assertEqual('a\nb', dev.GetProp('multi.line'))
+    self.assertEqual('', dev.GetProp('empty'))
+    self.assertEqual('x', dev.GetProp('missing', 'x'))
+    # Refreshing queries the device even for banner properties.
+    self.assertEqual('Pixel 2', dev.GetProp('ro.product.model', refresh=True))
+
+  def testGetPropBeforeConnect(self):
+    dev = adb_commands.AdbCommands()
+    with mock.patch.object(adb_commands.AdbCommands, 'GetProps', return_value={'a': 'b'}):
+      self.assertEqual('b', dev.GetProp('a'))
+
   def testConnectSerialString(self):
     dev = adb_commands.AdbCommands()
 
@@ -138,6 +184,222 @@ class AdbTest(BaseAdbTest):
     dev.ConnectDevice(handle=usb, banner=BANNER)
     self.assertEqual(response, dev.Uninstall(package_name))
 
+  def testStreamedInstall(self):
+    apk = tempfile.NamedTemporaryFile(suffix='.apk', delete=False)
+    self.addCleanup(os.remove, apk.name)
+    data = b'PK' * adb_protocol.MAX_ADB_DATA
+    apk.write(data)
+    apk.close()
+
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'exec:cmd package install -S %d -r\0' % len(data))
+    for i in range(0, len(data), adb_protocol.MAX_ADB_DATA):
+      self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, data[i:i + adb_protocol.MAX_ADB_DATA])
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'Success\n')
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    dev.features.add('cmd')
+    progress = mock.Mock()
+    self.assertEqual('Success\n', dev.Install(apk.name, transfer_progress_callback=progress))
+    self.assertEqual('streamed', dev.last_install_mode)
+    progress.assert_called_with(apk.name, len(data), len(data))
+
+  def testSideload(self):
+    package = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    self.addCleanup(os.remove, package.name)
+    block_size = adb_protocol.MAX_ADB_DATA + 100
+    data = os.urandom(block_size * 3 + 10)
+    package.write(data)
+    package.close()
+
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'sideload-host:%d:%d\0' % (len(data), block_size))
+    # Blocks may be requested in any order and more than once.
+    for block in (0, 3, 0):
+      self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'%08d' % block)
+      block_data = data[block * block_size:(block + 1) * block_size]
+      for i in range(0, len(block_data), adb_protocol.MAX_ADB_DATA):
+        self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, block_data[i:i + adb_protocol.MAX_ADB_DATA])
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'DONEDONE')
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    progress = mock.Mock()
+    dev.Sideload(package.name, block_size=block_size, progress_callback=progress)
+    progress.assert_called_with(package.name, 3, 4)
+    self.assertEqual([], usb.stub_base.read_data)
+
+    self._ExpectOpen(usb, b'sideload-host:%d:%d\0' % (len(data), block_size))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'FAILFAIL')
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+    with self.assertRaises(sideload.SideloadFailedError):
+      dev.Sideload(package.name, block_size=block_size)
+
+    # Bad requests close the stream too.
+    self._ExpectOpen(usb, b'sideload-host:%d:%d\0' % (len(data), block_size))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'%08d' % 4)
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+    with self.assertRaises(adb_protocol.InvalidResponseError):
+      dev.Sideload(package.name, block_size=block_size)
+    self.assertEqual([], usb.stub_base.written_data)
+
+  def testForward(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'tcp:8080\0')
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, b'hello')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'world')
+    # Closing the socket closes the stream.
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+    usb.stub_base.sequenced = True
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    server = dev.Forward(0, 'tcp:8080')
+    self.addCleanup(server.Close)
+    client = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+    client.sendall(b'hello')
+    self.assertEqual(b'world', client.recv(10))
+    client.close()
+    for _ in range(50):
+      if not usb.stub_base.read_data:
+        break
+      time.sleep(0.1)
+    self.assertEqual([], usb.stub_base.read_data)
+    self.assertEqual([], usb.stub_base.written_data)
+    # Closed servers are no longer closed with the connection.
+    server.Close()
+    self.assertEqual([], dev._forwards)
+    with self.assertRaises(ValueError):
+      dev.Forward(0)
+
+  def testOpenDeviceFile(self):
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as z:
+      z.writestr('big', os.urandom(256 * 1024))
+      z.writestr('small', b'small data')
+    archive = archive.getvalue()
+    block_size = 4096
+
+    def ExecOut(command, timeout_ms=None):
+      match = re.match(r'dd if=/data/app/base.apk bs=(\d+) skip=(\d+) count=(\d+) 2>/dev/null$', command)
+      bs, skip, count = (int(group) for group in match.groups())
+      return archive[bs * skip:bs * (skip + count)]
+
+    dev = adb_commands.AdbCommands()
+    with mock.patch.object(dev, 'Stat', return_value=(0o100644, len(archive), 0)), \
+        mock.patch.object(dev, 'ExecOut', side_effect=ExecOut) as exec_out:
+      with dev.OpenDeviceFile('/data/app/base.apk', block_size=block_size) as f:
+        with zipfile.ZipFile(f) as z:
+          self.assertEqual(['big', 'small'], z.namelist())
+          self.assertEqual(b'small data', z.read('small'))
+        # Only the end of the file was transferred, a few blocks at a time.
+        self.assertLess(f.bytes_fetched, 4 * block_size)
+        calls = exec_out.call_count
+        f.seek(10)
+        self.assertEqual(archive[10:20000], f.read(19990))
+        self.assertEqual(20000, f.tell())
+        self.assertEqual(archive[20000:30000], f.read(10000))
+        self.assertEqual(archive[-10:], f.read()[-10:])
+        self.assertEqual(b'', f.read(1))
+        # Sequential reads fetch more and more blocks at a time.
+        self.assertLess(exec_out.call_count - calls, 10)
+
+    with mock.patch.object(dev, 'Stat', return_value=(0, 0, 0)):
+      with self.assertRaises(usb_exceptions.AdbCommandFailureException):
+        dev.OpenDeviceFile('/missing')
+
+  def testInstallMultiPackage(self):
+    tmpdir = self._MakeTree(3)
+    apks = [[os.path.join(tmpdir, 'sub', 'f0'), os.path.join(tmpdir, 'sub', 'f1')],
+            [os.path.join(tmpdir, 'sub', 'f2')]]
+    dev = adb_commands.AdbCommands()
+    outputs = ['Success: created install session [11]', 'Success: created install session [12]',
+               'Success: created install session [13]', '', 'Success']
+    with mock.patch.object(dev, 'Shell', side_effect=outputs) as shell, \
+        mock.patch.object(dev, '_StreamFile', return_value='Success') as stream_file:
+      self.assertEqual('Success', dev.InstallMultiPackage(apks, parallel=2))
+    self.assertEqual(
+        ['pm install-create -r -S 12', 'pm install-create -r -S 6',
+         'pm install-create --multi-package -r', 'pm install-add-session 13 11 12', 'pm install-commit 13'],
+        [call[0][0] for call in shell.call_args_list])
+    self.assertEqual(
+        sorted(['pm install-write -S 6 11 0_f0 -', 'pm install-write -S 6 11 1_f1 -',
+                'pm install-write -S 6 12 0_f2 -']),
+        sorted(call[0][1] for call in stream_file.call_args_list))
+
+  def testInstallMultipleAbandonsOnFailure(self):
+    tmpdir = self._MakeTree(1)
+    dev = adb_commands.AdbCommands()
+    with mock.patch.object(dev, 'Shell', side_effect=['Success: [7]', '']) as shell, \
+        mock.patch.object(dev, '_StreamFile', return_value='Failure [INSTALL_FAILED]'):
+      with self.assertRaises(usb_exceptions.AdbCommandFailureException):
+        dev.InstallMultiple([os.path.join(tmpdir, 'sub', 'f0')])
+    shell.assert_called_with('pm install-abandon 7', timeout_ms=None)
+
+  def testInstallIfChanged(self):
+    tmpdir = self._MakeTree(1)
+    apk = os.path.join(tmpdir, 'sub', 'f0')
+    sha256 = hashlib.sha256(b'data 0').hexdigest()
+    dev = adb_commands.AdbCommands()
+    dev._handle = common_stub.StubUsb(device=None, setting=None)
+    dev.install_cache = adb_commands.InstallCache()
+    with mock.patch.object(dev, 'Shell', return_value='%s  /data/app/base.apk\n' % sha256) as shell, \
+        mock.patch.object(dev, 'Install') as install:
+      self.assertIsNone(dev.InstallIfChanged(apk, 'com.app'))
+      # The second check is answered from the cache.
+      self.assertIsNone(dev.InstallIfChanged(apk, 'com.app'))
+    self.assertEqual(1, shell.call_count)
+    self.assertFalse(install.called)
+    self.assertEqual('skipped', dev.last_install_mode)
+
+    dev.install_cache.Invalidate('stub')
+    with mock.patch.object(dev, 'Shell', return_value='') as shell, \
+        mock.patch.object(dev, 'Install', return_value='Success') as install:
+      self.assertEqual('Success', dev.InstallIfChanged(apk, 'com.app', timeout_ms=5))
+    install.assert_called_once_with(apk, package_name='com.app', timeout_ms=5)
+    self.assertEqual(sha256, dev.install_cache.Get('stub', 'com.app'))
+
+  def testPackageIndex(self):
+    dev = adb_commands.AdbCommands()
+    dev._handle = common_stub.StubUsb(device=None, setting=None)
+    listing = ('package:/data/app/~~a==/com.app-b==/base.apk=com.app versionCode:42\n'
+               'package:/system/app/Other.apk=com.other versionCode:1\n')
+    with mock.patch.object(dev, 'Shell', return_value=listing) as shell:
+      self.assertEqual('/data/app/~~a==/com.app-b==/base.apk', dev.packages.Get('com.app').path)
+      self.assertEqual(42, dev.packages.Get('com.app').version_code)
+      self.assertIn('com.other', dev.packages)
+      self.assertIsNone(dev.packages.Get('com.missing'))
+    shell.assert_called_once_with('pm list packages -f --show-versioncode')
+
+    # Uninstalls and named installs update their entry only.
+    with mock.patch.object(dev, 'Shell', return_value='Success') as shell:
+      dev.Uninstall('com.other')
+    self.assertNotIn('com.other', dev.packages)
+    with mock.patch.object(dev, '_StreamInstall', return_value='Success'), \
+        mock.patch.object(dev, 'Shell', return_value=listing.replace(':42', ':43')) as shell:
+      dev.Install('app.apk', streamed=True, package_name='com.app')
+    shell.assert_called_once_with('pm list packages -f --show-versioncode com.app')
+    self.assertEqual(43, dev.packages.Get('com.app').version_code)
+    self.assertEqual(1, len(dev.packages))
+
+    # Other installs re-query everything on next use.
+    with mock.patch.object(dev, '_StreamInstall', return_value='Success'):
+      dev.Install('app.apk', streamed=True)
+    with mock.patch.object(dev, 'Shell', return_value='package:/a.apk=com.a\n') as shell:
+      self.assertEqual(['com.a'], [info.name for info in dev.packages])
+      self.assertIsNone(dev.packages.Get('com.a').version_code)
+    self.assertEqual(1, shell.call_count)
+
   def testStreamingResponseShell(self):
     command = b'keepin it real big'
     # expect multiple lines
@@ -154,6 +416,264 @@ class AdbTest(BaseAdbTest):
       response_count = response_count + 1
     self.assertEqual(len(responses), response_count)
 
+  def testExecOut(self):
+    responses = [b'\x89PNG\xff', b'\xfe\x00']
+    usb = self._ExpectCommand(b'exec', b'screencap -p', *responses)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(b''.join(responses), dev.ExecOut('screencap -p'))
+
+  def testExecOutToFile(self):
+    responses = [b'\x89PNG\xff', b'\xfe\x00']
+    usb = self._ExpectCommand(b'exec', b'screencap -p', *responses)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    dest = BytesIO()
+    self.assertEqual(7, dev.ExecOut('screencap -p', dest))
+    self.assertEqual(b''.join(responses), dest.getvalue())
+
+  @classmethod
+  def _MakeShellPacket(cls, packet_id, data=b''):
+    return struct.pack(b'<BI', packet_id, len(data)) + data
+
+  def testExecIn(self):
+    data = b'\x00\xff' * adb_protocol.ShellV2Connection.max_payload
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb, features=b'shell_v2')
+    self._ExpectOpen(usb, b'shell,v2,raw:cat > /data/x\0')
+    max_payload = adb_protocol.ShellV2Connection.max_payload
+    for i in range(0, len(data), max_payload):
+      self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+          adb_protocol.SHELL_ID_STDIN, data[i:i + max_payload]))
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_CLOSE_STDIN))
+    response = (self._MakeShellPacket(adb_protocol.SHELL_ID_STDOUT, b'done') +
+                self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, b'warning') +
+                self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x03'))
+    # Split a packet across two writes from the device.
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, response[:7])
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, response[7:])
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual((b'done', b'warning', 3), dev.ExecIn('cat > /data/x', BytesIO(data)))
+
+  def testExecInWithoutShellV2(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    # No shell_v2 in the banner features, so shell v2 isn't tried.
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'exec:cat > /data/x\0')
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, b'abcdef')
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual((b'', b'', None), dev.ExecIn('cat > /data/x', [b'abc', b'def']))
+
+  def testCaptureShell(self):
+    responses = [b'line one\n\xc3', b'\xa9 two\n']
+    usb = self._ExpectCommand(b'shell', b'dumpsys', *responses)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    with dev.CaptureShell('dumpsys', max_memory=4) as output:
+      self.assertTrue(output.spilled)
+      self.assertEqual(u'line one\n\xe9 two\n', output.read())
+      self.assertEqual([u'line one\n', u'\xe9 two\n'], list(output.lines()))
+
+  def testStreamingShellLines(self):
+    responses = [b'first\r\nsec', b'ond \xc3', b'\xa9\r', b'\nlast']
+    usb = self._ExpectCommand(b'shell', b'cmd', *responses)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual([u'first', u'second \xe9', u'last'], list(dev.StreamingShellLines('cmd')))
+
+  def testLineBuffer(self):
+    buf = adb_protocol.LineBuffer(encoding=None, newline='\r\n', keepends=True)
+    self.assertEqual([], buf.feed(b'a\nb\r'))
+    self.assertEqual([b'a\nb\r\n'], buf.feed(b'\nc'))
+    self.assertEqual([b'c'], buf.flush())
+    self.assertEqual([], buf.flush())
+
+  def testShellV2(self):
+    usb = self._ExpectCommand(
+        b'shell,v2,raw', b'ls /missing',
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDOUT, b'out\n'),
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, b'No such file\n') +
+        self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x01'),
+        features=b'shell_v2')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(('out\n', 'No such file\n', 1), dev.Shell('ls /missing', shell_v2=True))
+
+  def testShellV2Fallback(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    # No shell_v2 in the banner features, so shell v2 isn't tried.
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'shell:echo hi\0')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, 0, b'hi\r\n')
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(('hi\r\n', '', None), dev.Shell('echo hi', shell_v2=True))
+
+  def testStreamingShellV2(self):
+    usb = self._ExpectCommand(
+        b'shell,v2,raw', b'cmd',
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDOUT, b'a'),
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, b'b') +
+        self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x00'),
+        features=b'shell_v2')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(
+        [(adb_protocol.SHELL_ID_STDOUT, 'a'), (adb_protocol.SHELL_ID_STDERR, 'b'),
+         (adb_protocol.SHELL_ID_EXIT, 0)],
+        list(dev.StreamingShell('cmd', shell_v2=True)))
+
+  def testShellBatch(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb, features=b'shell_v2')
+    self._ExpectOpen(usb, b'shell,v2,raw:sh\0')
+    with mock.patch('os.urandom', return_value=b'\x00' * 8):
+      dev = adb_commands.AdbCommands()
+      dev.ConnectDevice(handle=usb, banner=BANNER)
+      batch = dev.ShellBatch()
+    markers = [b'ADB_BATCH_0000000000000000_%d:' % i for i in range(2)]
+    script = b''.join(batch._Script(command, marker.decode()).encode()
+                      for command, marker in zip(['ls /x', 'cd /'], markers))
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDIN, script))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDERR, b'ls: /x: No such file\n' + markers[0] + b'\n'))
+    # The marker is split across packets.
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDOUT, markers[0][:5]))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDOUT, markers[0][5:] + b'1\n' + markers[1] + b'0\n') +
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, markers[1] + b'\n'))
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDIN, b'exit\n'))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_EXIT, b'\x00'))
+    self._ExpectClose(usb)
+
+    with batch:
+      self.assertEqual([('', 'ls: /x: No such file\n', 1), ('', '', 0)],
+                       batch.RunAll(['ls /x', 'cd /']))
+
+  def testInteractiveShellPromptAcrossPackets(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'shell:\0')
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, b'ls\r')
+    for data in (b'ls\r\r\na  b\x08\x08c\r\nshell@ham', b'merhead:/ $ '):
+      self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, data)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(b'a c', dev.InteractiveShell('ls', delim='shell@hammerhead:/ $ '))
+
+  def testStreamingInteractiveShell(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'shell:\0')
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, b'ls\r')
+    for data in (b'ls\r', b'\r\none\r\ntw', b'o\r\nshell@hammerhead:/ $ '):
+      self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, data)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual([b'one\r\n', b'two\r\n'],
+                     list(dev.StreamingInteractiveShell('ls', delim='shell@hammerhead:/ $ ')))
+
+  def testWaitForLogcat(self):
+    responses = [b'I/Act: Displ', b'ayed com.app\nE/AndroidRuntime: FATAL EXC', b'EPTION: main\n']
+    usb = self._ExpectCommand(b'shell', b'logcat -v brief', *responses)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    match = dev.WaitForLogcat(['FATAL EXCEPTION', re.compile(r'ANR in (\S+)')], options='-v brief')
+    self.assertEqual(('FATAL EXCEPTION', 'FATAL EXCEPTION', 'E/AndroidRuntime: FATAL EXCEPTION: main'),
+                     match)
+
+  def testMultiPatternMatcher(self):
+    regex = re.compile(r'ANR in (\S+)')
+    matcher = stream_match.MultiPatternMatcher(['he', 'she', 'hers', regex])
+    self.assertIsNone(matcher.feed(b'ANR in com.app\xc3'))
+    self.assertEqual((regex, 'ANR in com.app\xe9', 'ANR in com.app\xe9'), matcher.feed(b'\xa9\nus'))
+    self.assertEqual(('she', 'she', 'ushe'), matcher.feed(b'he'))
+
+  def testMultiPatternMatcherBackreference(self):
+    double = re.compile(r'(\w)\1')
+    fatal, crash = re.compile(r'FATAL'), re.compile(r'crash')
+    matcher = stream_match.MultiPatternMatcher([fatal, double, crash])
+    self.assertEqual((double, 'zz', 'a zz'), matcher.feed('a zz\n'))
+    self.assertEqual((crash, 'crash', 'crash FATAL'), matcher.feed('crash FATAL\n'))
+
+  @classmethod
+  def _MakeLogEntry(cls, priority, tag, message, header_size=24):
+    payload = struct.pack(b'<B', priority) + tag + b'\0' + message + b'\0'
+    header = struct.pack(b'<HHiIii', len(payload), header_size, 10, 11, 12, 13)
+    return header + b'\0' * (header_size - len(header)) + payload
+
+  def testBinaryLogcat(self):
+    data = (self._MakeLogEntry(logcat.INFO, b'Act', b'Displayed') +
+            self._MakeLogEntry(logcat.ERROR, b'Act', b'\xc3\xa9rror\n', header_size=0) +
+            self._MakeLogEntry(logcat.ERROR, b'Other', b'skipped'))
+    usb = self._ExpectCommand(b'exec', b'logcat -B -d', data[:30], data[30:])
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual([logcat.LogEntry(10, 11, 12, 13, logcat.ERROR, u'Act', u'\xe9rror')],
+                     list(dev.BinaryLogcat('-d', tags=['Act'], min_priority=logcat.WARN)))
+
+  def testCaptureLogcat(self):
+    entries = [logcat.LogEntry(1, 1, 100, i // 2, logcat.INFO, u'tag', u'line %d' % i) for i in range(4)]
+    first = mock.Mock()
+    first.BinaryLogcat.return_value = self._FailAfter(entries[:3])
+    second = mock.Mock()
+    # -T repeats the entries at the last timestamp.
+    second.BinaryLogcat.return_value = iter(entries[2:])
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+
+    capture = logcat.LogcatCapture(first, os.path.join(tmpdir, 'log'), options='-b main', max_bytes=50,
+                                   reconnect=lambda: second, retry_delay_s=0)
+    capture.Run()
+    second.BinaryLogcat.assert_called_once_with('-b main -T 100.000000001', timeout_ms=None)
+    # Each line is rotated to its own file.
+    lines = []
+    for path in capture.file.paths:
+      with open(path) as f:
+        lines.append(f.read())
+    self.assertEqual([logcat.FormatEntry(entry) for entry in entries], lines)
+
+  def testMergeLogcat(self):
+    devices = {}
+    for name, times in (('a', [(1, 0), (3, 0), (3, 500000000)]), ('b', [(2, 0), (2, 100000000), (6, 0)])):
+      devices[name] = mock.Mock()
+      devices[name].BinaryLogcat.return_value = [
+          logcat.LogEntry(1, 1, sec, nsec, logcat.INFO, name, '') for sec, nsec in times]
+    merged = list(logcat.MergeLogcat(devices, window_s=10))
+    self.assertEqual(['a', 'b', 'b', 'a', 'a', 'b'], [item.device for item in merged])
+    self.assertEqual(sorted(item.entry.sec * 10 ** 9 + item.entry.nsec for item in merged),
+                     [item.entry.sec * 10 ** 9 + item.entry.nsec for item in merged])
+
+  @staticmethod
+  def _FailAfter(entries):
+    for entry in entries:
+      yield entry
+    raise usb_exceptions.ReadFailedError('Disconnected', mock.Mock())
+
   def testReboot(self):
     usb = self._ExpectCommand(b'reboot', b'', b'')
     dev = adb_commands.AdbCommands()
@@ -190,6 +710,231 @@ class AdbTest(BaseAdbTest):
     dev.ConnectDevice(handle=usb, banner=BANNER)
     dev.DisableVerity()
 
+  def _MakeTree(self, count):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    os.mkdir(os.path.join(tmpdir, 'sub'))
+    for i in range(count):
+      with open(os.path.join(tmpdir, 'sub', 'f%d' % i), 'wb') as f:
+        f.write(b'data %d' % i)
+    return tmpdir
+
+  def testPushTar(self):
+    tmpdir = self._MakeTree(2)
+    expected = BytesIO()
+    with tarfile.open(fileobj=expected, mode='w|') as archive:
+      archive.add(os.path.join(tmpdir, 'sub'), arcname='sub', filter=adb_commands._ResetOwner)
+    expected = expected.getvalue()
+
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb, features=b'shell_v2')
+    self._ExpectOpen(usb, b"shell,v2,raw:mkdir -p /data/x && tar -x -C /data/x\0")
+    max_payload = adb_protocol.ShellV2Connection.max_payload
+    for i in range(0, len(expected), max_payload):
+      self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+          adb_protocol.SHELL_ID_STDIN, expected[i:i + max_payload]))
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_CLOSE_STDIN))
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_EXIT, b'\x00'))
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual('', dev.PushTar(tmpdir, '/data/x'))
+
+  def testPushTarReportsFailure(self):
+    tmpdir = self._MakeTree(1)
+    expected = BytesIO()
+    with tarfile.open(fileobj=expected, mode='w|') as archive:
+      archive.add(os.path.join(tmpdir, 'sub'), arcname='sub', filter=adb_commands._ResetOwner)
+    expected = expected.getvalue()
+    max_payload = adb_protocol.ShellV2Connection.max_payload
+    packets = [self._MakeShellPacket(adb_protocol.SHELL_ID_STDIN, expected[i:i + max_payload])
+               for i in range(0, len(expected), max_payload)]
+
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb, features=b'shell_v2')
+    self._ExpectOpen(usb, b"shell,v2,raw:mkdir -p /data/x && tar -x -C /data/x\0")
+    # tar fails while the first packet is in flight.
+    usb.ExpectWrite(self._MakeHeader(b'WRTE', LOCAL_ID, REMOTE_ID, packets[0]))
+    usb.ExpectWrite(packets[0])
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_STDERR, b'tar: not found\n') + self._MakeShellPacket(
+            adb_protocol.SHELL_ID_EXIT, b'\x7f'))
+    self._ExpectRead(usb, b'OKAY', REMOTE_ID, LOCAL_ID)
+    for packet in packets[1:]:
+      self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, packet)
+    self._ExpectWrite(usb, b'WRTE', LOCAL_ID, REMOTE_ID, self._MakeShellPacket(
+        adb_protocol.SHELL_ID_CLOSE_STDIN))
+    self._ExpectClose(usb)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    with self.assertRaises(usb_exceptions.AdbCommandFailureException) as cm:
+      dev.PushTar(tmpdir, '/data/x')
+    self.assertIn('tar: not found', str(cm.exception))
+
+  def testPushDirectoryChoosesBulk(self):
+    dev = adb_commands.AdbCommands()
+    many = adb_commands.BULK_PUSH_MIN_FILES
+    # Without shell v2 tar failures go unnoticed, so files are synced one by one.
+    for count, features, bulk in ((many, {'shell_v2'}, True), (1, {'shell_v2'}, False), (many, set(), False)):
+      dev.features = features
+      tmpdir = self._MakeTree(count)
+      with mock.patch.object(dev, 'PushTar') as push_tar, \
+          mock.patch.object(dev, 'Shell'), \
+          mock.patch.object(dev.filesync_handler, 'Push'), \
+          mock.patch.object(dev.protocol_handler, 'Open'):
+        dev.Push(tmpdir, '/data/x')
+      self.assertEqual(bulk, push_tar.called)
+
+  def testPushDirectoryBulkSkippedForProgress(self):
+    dev = adb_commands.AdbCommands()
+    dev.features.add('shell_v2')
+    tmpdir = self._MakeTree(adb_commands.BULK_PUSH_MIN_FILES)
+    os.symlink('missing', os.path.join(tmpdir, 'sub', 'broken'))
+    self.assertTrue(dev._IsBulkTree(tmpdir))
+    with mock.patch.object(dev, 'PushTar') as push_tar, \
+        mock.patch.object(dev, 'Shell'), \
+        mock.patch.object(dev.filesync_handler, 'Push'), \
+        mock.patch.object(dev.protocol_handler, 'Open'), \
+        mock.patch('adb.adb_commands.open', create=True):
+      dev.Push(tmpdir, '/data/x', progress_callback=lambda *args: None)
+    self.assertFalse(push_tar.called)
+
+  def testWriteKeepsDataSentBeforeOkay(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectOpen(usb, b'exec:cat\0')
+    usb.ExpectWrite(self._MakeHeader(b'WRTE', LOCAL_ID, REMOTE_ID, b'in'))
+    usb.ExpectWrite(b'in')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'out')
+    self._ExpectRead(usb, b'OKAY', REMOTE_ID, LOCAL_ID)
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+    self._ExpectWrite(usb, b'CLSE', LOCAL_ID, REMOTE_ID, b'')
+
+    connection = adb_protocol.AdbMessage.Open(usb, b'exec:cat')
+    self.assertEqual(2, connection.Write(b'in'))
+    self.assertEqual([b'out'], list(connection.ReadUntilClose()))
+
+  def testInterleavedStreams(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectOpen(usb, b'exec:a\0')
+    self._ExpectWrite(usb, b'OPEN', 2, 0, b'exec:b\0')
+    self._ExpectRead(usb, b'OKAY', REMOTE_ID + 1, 2)
+    # Stream 2's data arrives while stream 1 is being read.
+    usb.ExpectRead(self._MakeHeader(b'WRTE', REMOTE_ID + 1, 2, b'for b'))
+    usb.ExpectRead(b'for b')
+    self._ExpectRead(usb, b'WRTE', REMOTE_ID, LOCAL_ID, b'for a')
+    self._ExpectWrite(usb, b'OKAY', 2, REMOTE_ID + 1, b'')
+
+    first = adb_protocol.AdbMessage.Open(usb, b'exec:a')
+    second = adb_protocol.AdbMessage.Open(usb, b'exec:b')
+    self.assertEqual((b'WRTE', b'for a'), first.ReadUntil(b'WRTE'))
+    self.assertEqual((b'WRTE', b'for b'), second.ReadUntil(b'WRTE'))
+
+  def testShellPool(self):
+    sessions = [mock.MagicMock(closed=False) for _ in range(3)]
+    pool = adb_commands.ShellSessionPool(mock.Mock(side_effect=sessions), size=2)
+    first = pool.Checkout()
+    second = pool.Checkout()
+    with self.assertRaises(usb_exceptions.AdbOperationException):
+      pool.Checkout(timeout_s=0)
+    pool.Return(first)
+    self.assertIs(first, pool.Checkout())
+    pool.Return(first, broken=True)
+    first.Close.assert_called_once_with()
+    second.closed = True
+    pool.Return(second)
+    # The closed session is replaced.
+    self.assertIs(sessions[2], pool.Checkout())
+    second.Close.assert_called_once_with()
+
+  def testShellPoolSessionClosedByDevice(self):
+    usb = common_stub.StubUsb(device=None, setting=None)
+    self._ExpectConnection(usb)
+    self._ExpectOpen(usb, b'shell:\0')
+    # The shell exits while we wait for its output.
+    self._ExpectRead(usb, b'CLSE', REMOTE_ID, LOCAL_ID)
+    # The replacement session gets the released local id.
+    self._ExpectOpen(usb, b'shell:\0')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    pool = dev.ShellPool(size=1)
+    session = pool.Checkout()
+    self.assertEqual('', dev.InteractiveShell(conn=session))
+    self.assertTrue(session.closed)
+    # Discarding the dead session doesn't wait for another CLSE.
+    pool.Return(session)
+    replacement = pool.Checkout(timeout_s=0)
+    self.assertIsNot(session, replacement)
+    self.assertEqual([], usb.stub_base.read_data)
+    self.assertEqual([], usb.stub_base.written_data)
+
+  def testPullTar(self):
+    archive_data = BytesIO()
+    with tarfile.open(fileobj=archive_data, mode='w|') as archive:
+      info = tarfile.TarInfo('sub/f')
+      info.size = 4
+      archive.addfile(info, BytesIO(b'data'))
+    archive_data = archive_data.getvalue()
+    max_payload = adb_protocol.ShellV2Connection.max_payload
+    packets = [self._MakeShellPacket(adb_protocol.SHELL_ID_STDOUT, archive_data[i:i + max_payload])
+               for i in range(0, len(archive_data), max_payload)]
+    packets.append(self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, b'tar: warning'))
+    packets.append(self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x00'))
+    usb = self._ExpectCommand(b'shell,v2,raw', b'tar -c -C /data/x .', *packets, features=b'shell_v2')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    self.assertEqual(['sub/f'], dev.PullTar('/data/x', tmpdir))
+    with open(os.path.join(tmpdir, 'sub', 'f'), 'rb') as f:
+      self.assertEqual(b'data', f.read())
+
+  def testPullTarWithoutDataFilter(self):
+    if hasattr(tarfile, 'data_filter'):
+      self.addCleanup(setattr, tarfile, 'data_filter', tarfile.data_filter)
+      del tarfile.data_filter
+    archive_data = BytesIO()
+    with tarfile.open(fileobj=archive_data, mode='w|') as archive:
+      for name in ('../evil', '/abs', 'ok/f'):
+        info = tarfile.TarInfo(name)
+        info.size = 4
+        archive.addfile(info, BytesIO(b'data'))
+      link = tarfile.TarInfo('ok/link')
+      link.type = tarfile.SYMTYPE
+      link.linkname = '../../outside'
+      archive.addfile(link)
+    packets = [self._MakeShellPacket(adb_protocol.SHELL_ID_STDOUT, archive_data.getvalue()),
+               self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x00')]
+    usb = self._ExpectCommand(b'shell,v2,raw', b'tar -c -C /data/x .', *packets, features=b'shell_v2')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    parent = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, parent)
+    tmpdir = os.path.join(parent, 'dest')
+    # Members are kept inside tmpdir, links leaving it are skipped.
+    self.assertEqual(['evil', 'abs', 'ok/f'], dev.PullTar('/data/x', tmpdir))
+    self.assertEqual(['dest'], os.listdir(parent))
+    self.assertEqual(['f'], os.listdir(os.path.join(tmpdir, 'ok')))
+
+  def testPullTarReportsMissingTar(self):
+    usb = self._ExpectCommand(
+        b'shell,v2,raw', b'tar -c -C /data/x .',
+        self._MakeShellPacket(adb_protocol.SHELL_ID_STDERR, b'tar: not found') +
+        self._MakeShellPacket(adb_protocol.SHELL_ID_EXIT, b'\x7f'),
+        features=b'shell_v2')
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    with self.assertRaises(usb_exceptions.AdbCommandFailureException) as cm:
+      dev.PullTar('/data/x', tempfile.gettempdir())
+    self.assertIn('tar: not found', str(cm.exception))
+
 class FilesyncAdbTest(BaseAdbTest):
 
   @classmethod
@@ -250,6 +995,174 @@ class FilesyncAdbTest(BaseAdbTest):
     dev.ConnectDevice(handle=usb, banner=BANNER)
     self.assertEqual(filedata, dev.Pull('/data'))
 
+  def testPushOverlappedIO(self):
+    filedata = b'x' * (filesync_protocol.MAX_PUSH_DATA + 100)
+    mtime = 100
+
+    send = [
+        self._MakeWriteSyncPacket(b'SEND', b'/data,33272'),
+        self._MakeWriteSyncPacket(b'DATA', filedata[:filesync_protocol.MAX_PUSH_DATA]),
+        self._MakeWriteSyncPacket(b'DATA', filedata[filesync_protocol.MAX_PUSH_DATA:]),
+        self._MakeWriteSyncPacket(b'DONE', size=mtime),
+    ]
+    data = b'OKAY\0\0\0\0'
+    usb = self._ExpectSyncCommand([b''.join(send)], [data])
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    dev.Push(BytesIO(filedata), '/data', mtime=mtime, overlap_io=True)
+
+  def testPullOverlappedIO(self):
+    filedata = b"g'ddayta, govnah"
+
+    recv = self._MakeWriteSyncPacket(b'RECV', b'/data')
+    data = [
+        self._MakeWriteSyncPacket(b'DATA', filedata),
+        self._MakeWriteSyncPacket(b'DONE'),
+    ]
+    usb = self._ExpectSyncCommand([recv], [b''.join(data)])
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+
+    dest = BytesIO()
+    self.assertEqual(filedata, dev.Pull('/data', dest, overlap_io=True))
+
+  def testPushRegularFile(self):
+    filedata = b'x' * (filesync_protocol.MAX_PUSH_DATA + 100)
+    mtime = 100
+
+    send = [
+        self._MakeWriteSyncPacket(b'SEND', b'/data,33272'),
+        self._MakeWriteSyncPacket(b'DATA', filedata[:filesync_protocol.MAX_PUSH_DATA]),
+        self._MakeWriteSyncPacket(b'DATA', filedata[filesync_protocol.MAX_PUSH_DATA:]),
+        self._MakeWriteSyncPacket(b'DONE', size=mtime),
+    ]
+    data = b'OKAY\0\0\0\0'
+    usb = self._ExpectSyncCommand([b''.join(send)], [data])
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    with tempfile.NamedTemporaryFile() as source:
+      source.write(filedata)
+      source.flush()
+      source.seek(0)
+      dev.Push(source, '/data', mtime=mtime)
+
+  def testPullToFilename(self):
+    filedata = b"g'ddayta, govnah"
+
+    stat = self._MakeWriteSyncPacket(b'STAT', b'/data')
+    stat_response = self._MakeSyncHeader(b'STAT', 0o100644, len(filedata) - 2, 0)
+    recv = self._MakeWriteSyncPacket(b'RECV', b'/data')
+    data = [
+        self._MakeWriteSyncPacket(b'DATA', filedata),
+        self._MakeWriteSyncPacket(b'DONE'),
+    ]
+    usb = self._ExpectSyncCommand([stat, recv], [stat_response, b''.join(data)])
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    dest = os.path.join(tmpdir, 'data')
+    # The file grew since it was stat'ed, the tail is written without the map.
+    with mock.patch.object(filesync_protocol, 'WriterThread',
+                           wraps=filesync_protocol.WriterThread) as writer_thread:
+      self.assertTrue(dev.Pull('/data', dest))
+    # The map is written on a helper thread by default.
+    self.assertTrue(writer_thread.called)
+    with open(dest, 'rb') as f:
+      self.assertEqual(filedata, f.read())
+
+  def testPushIter(self):
+    chunks = [b'a' * (filesync_protocol.MAX_PUSH_DATA + 10), b'', b'bc']
+    mtime = 100
+
+    send = [
+        self._MakeWriteSyncPacket(b'SEND', b'/data,33272'),
+        self._MakeWriteSyncPacket(b'DATA', chunks[0][:filesync_protocol.MAX_PUSH_DATA]),
+        self._MakeWriteSyncPacket(b'DATA', chunks[0][filesync_protocol.MAX_PUSH_DATA:]),
+        self._MakeWriteSyncPacket(b'DATA', chunks[2]),
+        self._MakeWriteSyncPacket(b'DONE', size=mtime),
+    ]
+    data = b'OKAY\0\0\0\0'
+    usb = self._ExpectSyncCommand([b''.join(send)], [data])
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    dev.PushIter((chunk for chunk in chunks), '/data', mtime=mtime)
+
+  def testPullIter(self):
+    chunks = [b"g'dday", b'ta, govnah']
+
+    recv = self._MakeWriteSyncPacket(b'RECV', b'/data')
+    data = [self._MakeWriteSyncPacket(b'DATA', chunk) for chunk in chunks]
+    data.append(self._MakeWriteSyncPacket(b'DONE'))
+    usb = self._ExpectSyncCommand([recv], [b''.join(data)])
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    self.assertEqual(chunks, [bytes(chunk) for chunk in dev.PullIter('/data')])
+
+  def testPushArchive(self):
+    members = [(b'hello', 'a.txt', 0o644, 100), (b'world', '../dir/b.txt', 0o755, 200)]
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as archive:
+      for data, name, mode, mtime in members:
+        info = tarfile.TarInfo(name)
+        info.size, info.mode, info.mtime = len(data), mode, mtime
+        archive.addfile(info, BytesIO(data))
+    buf.seek(0)
+
+    send = []
+    for data, name, mode, mtime in members:
+      send.append(b''.join([
+          self._MakeWriteSyncPacket(
+              b'SEND', '/sdcard/%s,%d' % (name.lstrip('./'), 0o100000 | mode)),
+          self._MakeWriteSyncPacket(b'DATA', data),
+          self._MakeWriteSyncPacket(b'DONE', size=mtime),
+      ]))
+    usb = self._ExpectSyncCommand(send, [b'OKAY\0\0\0\0'] * 2)
+
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+    with tarfile.open(fileobj=buf, mode='r|') as archive:
+      self.assertEqual(['/sdcard/a.txt', '/sdcard/dir/b.txt'],
+                       dev.PushArchive(archive, '/sdcard'))
+
+  def testPullArchive(self):
+    filedata = b'some data'
+
+    def Dent(name, mode, size):
+      return self._MakeSyncHeader(b'DENT', mode, size, 100, len(name)) + name
+
+    writes = [
+        self._MakeWriteSyncPacket(b'LIST', b'/sdcard'),
+        self._MakeWriteSyncPacket(b'RECV', b'/sdcard/a.txt'),
+        self._MakeWriteSyncPacket(b'LIST', b'/sdcard/sub'),
+    ]
+    reads = [
+        b''.join([
+            Dent(b'.', 0o40755, 0),
+            Dent(b'a.txt', 0o100644, len(filedata)),
+            Dent(b'\xff', 0o20666, 0),
+            Dent(b'sub', 0o40755, 0),
+            self._MakeSyncHeader(b'DONE', 0, 0, 0, 0),
+        ]),
+        self._MakeWriteSyncPacket(b'DATA', filedata) + self._MakeWriteSyncPacket(b'DONE'),
+        self._MakeSyncHeader(b'DONE', 0, 0, 0, 0),
+    ]
+    usb = self._ExpectSyncCommand(writes, reads)
+    dev = adb_commands.AdbCommands()
+    dev.ConnectDevice(handle=usb, banner=BANNER)
+
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode='w|') as archive:
+      self.assertEqual(['a.txt', 'sub'], dev.PullArchive('/sdcard', archive))
+    buf.seek(0)
+    with tarfile.open(fileobj=buf) as archive:
+      self.assertEqual(filedata, archive.extractfile('a.txt').read())
+      self.assertTrue(archive.getmember('sub').isdir())
+
 
 class TcpTimeoutAdbTest(BaseAdbTest):
         
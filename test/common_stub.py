@@ -4,6 +4,7 @@ import binascii
 import signal
 import string
 import sys
+import threading
 import time
 from mock import mock
 
@@ -25,6 +26,13 @@ class StubHandleBase(object):
     self.read_data = []
     self.is_tcp = is_tcp
     self.timeout_ms = timeout_ms
+    # When set, each read waits for the writes expected before it, for
+    # threads writing and reading concurrently.
+    self.sequenced = False
+    self._writes_expected = 0
+    self._writes_done = 0
+    self._reads_after = []
+    self._cond = threading.Condition()
 
   def _signal_handler(self, signum, frame):
       raise TcpTimeoutException('End of time')
@@ -41,11 +49,13 @@ class StubHandleBase(object):
     if not isinstance(data, bytes):
       data = data.encode('utf8')
     self.written_data.append(data)
+    self._writes_expected += 1
 
   def ExpectRead(self, data):
     if not isinstance(data, bytes):
       data = data.encode('utf8')
     self.read_data.append(data)
+    self._reads_after.append(self._writes_expected)
 
   def BulkWrite(self, data, timeout_ms=None):
     expected_data = self.written_data.pop(0)
@@ -60,9 +70,18 @@ class StubHandleBase(object):
     if self.is_tcp and b'i_need_a_timeout' in data:
       self._alarm_sounder(timeout_ms)
       time.sleep(2*self._return_seconds(timeout_ms))
+    with self._cond:
+      self._writes_done += 1
+      self._cond.notify_all()
 
   def BulkRead(self, length,
                timeout_ms=None):  # pylint: disable=unused-argument
+    writes_before = self._reads_after.pop(0)
+    if self.sequenced:
+      deadline = time.time() + 5
+      with self._cond:
+        while self._writes_done < writes_before and time.time() < deadline:
+          self._cond.wait(0.1)
     data = self.read_data.pop(0)
     if length < len(data):
       raise ValueError(
@@ -83,6 +102,10 @@ class StubUsb(UsbHandle):
     super(StubUsb, self).__init__(device, setting, usb_info, timeout_ms)
     self.stub_base = StubHandleBase(0)
 
+  @property
+  def serial_number(self):
+    return 'stub'
+
   def ExpectWrite(self, data):
     return self.stub_base.ExpectWrite(data)
 